@@ -0,0 +1,379 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Benchmark of both exporters against local stand-ins for HAFSQL and the Hive API, so runs can be
+# compared without the rate limits and the varying latency of the public endpoints. Synthetic accounts
+# get a fixed number of operations spread evenly over the date range, and every stage reports wall
+# time, rows/s, peak RSS and the round trips made to the fake backends.
+#
+#   python benchmark.py hafsql --accounts 10 --ops 100000 --latency 0.005
+#   python benchmark.py beem --accounts 2 --ops 20000
+
+start_date = datetime(2024, 1, 1)
+end_date = datetime(2024, 12, 31, 23, 59, 59)
+
+round_trips = {'sql_queries': 0, 'sql_fetches': 0, 'history_pages': 0, 'rpc_requests': 0}
+round_trips_lock = threading.Lock()
+
+def count(name, n=1):
+    with round_trips_lock:
+        round_trips[name] += n
+
+def synthetic_timestamps(ops, range_start, range_end):
+    # ops timestamps spread evenly over the benchmark range, limited to the requested range
+    step = (end_date - start_date) / max(ops, 1)
+    first = max(0, int((range_start - start_date) / step) - 1)
+    last = min(ops - 1, int((range_end - start_date) / step) + 1)
+    for k in range(first, last + 1):
+        timestamp = (start_date + step * k).replace(microsecond=0)
+        if range_start <= timestamp <= range_end:
+            yield k, timestamp
+
+def synthetic_operation_id(ops, timestamp):
+    # Id of the first operation at or after the timestamp, like hafsql.id_from_timestamp
+    step = (end_date - start_date) / max(ops, 1)
+    k = max(0, int((timestamp - start_date) / step) - 1)
+    while k < ops and history_timestamp(ops, k) < timestamp:
+        k += 1
+    return k
+
+# HAFSQL stand-in
+
+class FakeCursor:
+    # Answers the exporter's queries with synthetic rows in the shape of the real ones
+    def __init__(self, database, name=None):
+        self.database = database
+        self.name = name
+        self.itersize = 2000
+        self.rows = []
+
+    def execute(self, query, params=None):
+        count('sql_queries')
+        time.sleep(self.database.latency)
+        self.rows = self.database.answer(query, params)
+        if self.name is None:
+            count('sql_fetches')
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def __iter__(self):
+        # Named cursors fetch itersize rows per round trip
+        for i in range(0, len(self.rows), self.itersize):
+            count('sql_fetches')
+            time.sleep(self.database.latency)
+            yield from self.rows[i:i+self.itersize]
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    closed = 0
+
+    def __init__(self, database):
+        self.database = database
+
+    def cursor(self, name=None):
+        return FakeCursor(self.database, name)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+class FakeDatabase:
+    # Drop-in replacement for the exporter's DatabasePool
+    def __init__(self, ops_per_type, latency):
+        self.ops_per_type = ops_per_type
+        self.latency = latency
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield FakeConnection(self)
+
+    def close(self):
+        pass
+
+    def answer(self, query, params):
+        if 'hafsql.id_from_timestamp' in query:
+            return [(synthetic_operation_id(self.ops_per_type, t),) for t in params['timestamps']]
+        if 'unnest' in query:
+            # hafsql.vests_to_hive once per block
+            return [(b, params['vests'] * Decimal(500 + b % 1000) / 1000000) for b in params['blocks']]
+        rows = list(self.operations(query, params))
+        if 'GROUP BY' not in query:
+            return rows
+        # Server side aggregation, sums per day and group with the last id
+        sums = {}
+        for row in rows:
+            if row[7] > 0:
+                key = (row[0], row[1].replace(hour=0, minute=0, second=0)) + row[2:7]
+                amount, last_id = sums.get(key, (0, 0))
+                sums[key] = (amount + row[7], max(last_id, row[8]))
+        return [key + value for key, value in sums.items()]
+
+    def operations(self, query, params):
+        tx_type = re.search(r"'(\w+)' AS type", query).group(1)
+        currencies = re.findall(r"'(HBD|HIVE|HP)' AS currency", query) or ['HIVE']
+        accounts = params['accounts']
+        two_sided = 'NULL AS account' in query
+        raw_vests = 'AS vests_amount' in query
+        for a in accounts:
+            for k in range(params['start_id'], min(params['end_id'], self.ops_per_type - 1) + 1):
+                timestamp = history_timestamp(self.ops_per_type, k)
+                counterparty = f"counterparty{k % 50}"
+                if raw_vests:
+                    # HBD, HIVE and VESTS amounts with the block number, blocks repeat every 10 operations
+                    sender, recipient = (a, counterparty) if k % 2 else (counterparty, a)
+                    amounts = (Decimal(k % 7) / 1000, Decimal(k % 5) / 1000, Decimal(k * 1000 + 1) / 1000000, 80000000 + k // 10 * 3, k)
+                    yield (None, timestamp, tx_type, None, sender, recipient) + amounts if two_sided else (a, timestamp, tx_type, 'incoming', 'hive.rewards', a) + amounts
+                    continue
+                for currency in currencies:
+                    amount = Decimal(k % 1000 + 1) / 1000
+                    if two_sided:
+                        sender, recipient = (a, counterparty) if k % 2 else (counterparty, a)
+                        yield (None, timestamp, tx_type, None, sender, recipient, currency, amount, k)
+                    else:
+                        yield (a, timestamp, tx_type, 'incoming', 'hive.rewards', a, currency, amount, k)
+
+# Hive API stand-ins
+
+history_op_types = ['transfer', 'curation_reward', 'author_reward', 'fill_order', 'interest', 'delegate_vesting_shares', 'vote']
+
+def asset(amount, nai='@@000000021', precision=3):
+    return {'amount': str(amount), 'precision': precision, 'nai': nai}
+
+def synthetic_operation(account_name, k):
+    # Type and value of history entry k of a synthetic account
+    other = f"counterparty{k % 50}"
+    return history_op_types[k % len(history_op_types)], {
+        'from': account_name if k % 2 else other, 'to': other if k % 2 else account_name, 'amount': asset(k % 1000 + 1, '@@000000013' if k % 3 else '@@000000021'),
+        'interest': asset(k % 100 + 1, '@@000000013'), 'owner': account_name,
+        'reward': asset(k * 1000 + 1, '@@000000037', 6), 'vesting_shares': asset(k * 1000 + 1, '@@000000037', 6),
+        'author': account_name, 'hbd_payout': asset(k % 7), 'hive_payout': asset(k % 5), 'vesting_payout': asset(k * 100, '@@000000037', 6),
+        'current_owner': account_name if k % 2 else other, 'open_owner': other if k % 2 else account_name,
+        'current_pays': asset(k % 500 + 1), 'open_pays': asset(k % 300 + 1, '@@000000013'),
+        'delegator': account_name, 'delegatee': other,
+    }
+
+def history_timestamp(ops, k):
+    return (start_date + (end_date - start_date) / max(ops, 1) * k).replace(microsecond=0)
+
+class RPCHandler(BaseHTTPRequestHandler):
+    # hafsql.dynamic_global_properties for single calls and batches, and account_history_api.get_account_history
+    # for synthetic accounts with ops entries each
+    latency = 0
+    ops = 0
+
+    def answer(self, call):
+        params = call['params']
+        if call['method'] == 'account_history_api.get_account_history':
+            start = self.ops - 1 if params['start'] == -1 else min(params['start'], self.ops - 1)
+            history = []
+            for k in range(max(0, start - params['limit'] + 1), start + 1):
+                op_type, value = synthetic_operation(params['account'], k)
+                history.append([k, {'block': 80000000 + k * 3, 'timestamp': history_timestamp(self.ops, k).isoformat(), 'op': {'type': op_type + '_operation', 'value': value}}])
+            return {'history': history}
+        block_num = params['block_num']
+        return [{'total_vesting_fund_hive': str(150000000000 + block_num), 'total_vesting_shares': str(300000000000000000 + block_num * 1000)}]
+
+    def do_POST(self):
+        count('rpc_requests')
+        time.sleep(self.latency)
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        calls = request if isinstance(request, list) else [request]
+        results = [{'jsonrpc': '2.0', 'id': call['id'], 'result': self.answer(call)} for call in calls]
+        body = json.dumps(results if isinstance(request, list) else results[0]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def fake_account_class(ops, latency, page_size=1000):
+    class FakeAccount:
+        # Stand-in for beem's Account with the same history, one round trip per page of entries
+        def __init__(self, name, blockchain_instance=None):
+            self.name = name
+
+        def history_reverse(self, start=None, stop=None, **kwargs):
+            entries = list(synthetic_timestamps(ops, stop if isinstance(stop, datetime) else start_date, start))
+            for n, (k, timestamp) in enumerate(reversed(entries)):
+                if n % page_size == 0:
+                    count('history_pages')
+                    time.sleep(latency)
+                op_type, value = synthetic_operation(self.name, k)
+                yield dict(value, type=op_type, timestamp=history_timestamp(ops, k).isoformat(), block=80000000 + k * 3, index=k)
+
+    return FakeAccount
+
+# Runner
+
+class StageTimer:
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        before = dict(round_trips)
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        result = {}
+        yield result
+        elapsed = time.perf_counter() - started
+        stage = self.stages.setdefault(name, {'seconds': 0, 'rows': 0, 'round_trips': {k: 0 for k in round_trips}})
+        stage['seconds'] += elapsed
+        stage['rows'] += result.get('rows', 0)
+        for k in round_trips:
+            stage['round_trips'][k] += round_trips[k] - before[k]
+        # ru_maxrss is in kilobytes on Linux
+        stage['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        if self.trace_memory:
+            stage['peak_traced_mb'] = max(stage.get('peak_traced_mb', 0), tracemalloc.get_traced_memory()[1] / 2**20)
+
+    def report(self):
+        for stage in self.stages.values():
+            stage['rows_per_second'] = round(stage['rows'] / stage['seconds']) if stage['seconds'] else None
+            stage['seconds'] = round(stage['seconds'], 3)
+            stage['peak_rss_mb'] = round(stage['peak_rss_mb'], 1)
+        return self.stages
+
+def run_hafsql(args, timer):
+    import hive_tx_to_csv_hafsql as exporter
+
+    exporter.database = FakeDatabase(args.ops, args.latency)
+    exporter.streaming = args.streaming
+    exporter.stream_itersize = args.itersize
+    exporter.server_aggregation = args.server_aggregation
+    exporter.client_vests_conversion = args.client_vests
+    exporter.day_buckets = args.day_buckets
+    exporter.ratio_database = exporter.database
+    exporter.ratio_cache_file = None
+    exporter.operation_store = None
+    exporter.start_date, exporter.end_date = start_date, end_date
+    accounts = [f"account{i}" for i in range(args.accounts)]
+    for i in range(0, len(accounts), args.batch_size):
+        batch = accounts[i:i+args.batch_size]
+        with timer.stage('fetch') as stage:
+            transactions = exporter.get_transactions_for_accounts(batch, start_date, end_date)
+            stage['rows'] = sum(len(t) for t in transactions.values())
+        for a in batch:
+            with timer.stage('aggregate') as stage:
+                stage['rows'] = len(transactions[a])
+                aggregated_data = exporter.aggregate_transactions(transactions.pop(a))
+            with timer.stage('write') as stage:
+                stage['rows'] = len(aggregated_data)
+                aggregated_data.to_csv(f"{a}.csv", index=False)
+
+def run_beem(args, timer):
+    import hive_tx_to_csv as exporter
+    import transport
+
+    RPCHandler.latency = args.latency
+    RPCHandler.ops = args.ops
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RPCHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    exporter.hafsql = f"http://127.0.0.1:{server.server_address[1]}"
+    # A second address for the same server, so history segments are spread over two nodes
+    exporter.node_pool = transport.NodePool([exporter.hafsql, exporter.hafsql + "/"])
+    exporter.history_workers = args.history_workers
+    exporter.get_account = fake_account_class(args.ops, args.latency)
+    exporter.get_hive = lambda: None
+    exporter.ratio_cache = exporter.VestsToHiveRatioCache(exporter.get_vests_to_hive_ratios, exporter.get_vests_to_hive_ratio, None, exporter.ratio_batch_size, args.ratio_stride, exporter.ratio_interpolation_tolerance)
+    exporter.operation_store = None
+    transport.http_retries = 0
+    try:
+        for a in [f"account{i}" for i in range(args.accounts)]:
+            with timer.stage('fetch') as stage:
+                transactions = exporter.get_transactions_for_account(a, start_date, end_date)
+                stage['rows'] = len(transactions)
+            with timer.stage('aggregate') as stage:
+                stage['rows'] = len(transactions)
+                aggregated_data = exporter.aggregate_transactions(transactions)
+            with timer.stage('write') as stage:
+                stage['rows'] = len(aggregated_data)
+                aggregated_data.to_csv(f"{a}.csv", index=False)
+    finally:
+        server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the exporters against local fake backends.')
+    parser.add_argument('backend', choices=['hafsql', 'beem'])
+    parser.add_argument('--accounts', type=int, default=3, help='number of synthetic accounts')
+    parser.add_argument('--ops', type=int, default=10000, help='operations per account (per operation type for hafsql)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every round trip')
+    parser.add_argument('--batch-size', type=int, default=50, help='accounts per HAFSQL batch')
+    parser.add_argument('--streaming', action='store_true', help='use server side cursors (hafsql)')
+    parser.add_argument('--server-aggregation', action='store_true', help='sum per day in the queries (hafsql)')
+    parser.add_argument('--client-vests', action='store_true', help='convert VESTS to HP client side (hafsql)')
+    parser.add_argument('--day-buckets', action='store_true', help='date rows by the day of their operation id (hafsql)')
+    parser.add_argument('--itersize', type=int, default=10000, help='rows per fetch when streaming')
+    parser.add_argument('--history-workers', type=int, default=4, help='history segments fetched at a time (beem, 0 for history_reverse)')
+    parser.add_argument('--ratio-stride', type=int, default=None, help='ratio sample stride in blocks (beem)')
+    parser.add_argument('--trace-memory', action='store_true', help='also report the peak of Python allocations per stage (slower)')
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the exporter')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    timer = StageTimer(args.trace_memory)
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    output = None if args.verbose else io.StringIO()
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            with contextlib.redirect_stdout(output) if output is not None else contextlib.nullcontext():
+                if args.backend == 'hafsql':
+                    run_hafsql(args, timer)
+                else:
+                    run_beem(args, timer)
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        'backend': args.backend,
+        'accounts': args.accounts,
+        'ops': args.ops,
+        'latency': args.latency,
+        'wall_seconds': round(time.perf_counter() - started, 3),
+        'round_trips': dict(round_trips),
+        'stages': timer.report(),
+    }
+    # Time and counters of the exporter's own instrumentation
+    import instrumentation
+    report['instrumentation'] = instrumentation.report()
+    for name, stage in report['stages'].items():
+        trips = ', '.join(f"{k}={v}" for k, v in stage['round_trips'].items() if v)
+        print(f"{name:10} {stage['seconds']:9.3f}s {stage['rows']:>10} rows {stage['rows_per_second'] or 0:>10} rows/s {stage['peak_rss_mb']:8.1f} MB peak RSS  {trips}")
+    print(f"{'total':10} {report['wall_seconds']:9.3f}s")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import json
+import sys
+from datetime import datetime, timedelta
+
+# Command line entry point of engine.py. Accounts, the range and any other parameter come from the arguments or
+# a JSON config file, the arguments taking precedence. Only the standard library is imported up front: pandas,
+# requests, psycopg2 and beem are loaded by the stages that use them, so dry runs start in a fraction of a second.
+#
+#   python cli.py --accounts alice bob --start 2024-01-01 --end 2024-12-31
+#   python cli.py --config export.json --dry-run
+#   python cli.py --accounts alice --cache-only operations_hafsql
+#
+# A config file holds parameters of engine.py, and parameters of the backends in sections named after their source:
+#
+#   {"account_names": ["alice", "bob"], "start_date": "2024-01-01", "end_date": "2024-12-31",
+#    "sources": ["hafsql", "rpc"], "output_format": "parquet",
+#    "hafsql": {"streaming": true}, "rpc": {"history_workers": 8}}
+
+# Parameters given as ISO dates, and as a number of days
+date_parameters = ['start_date', 'end_date']
+day_parameters = ['plan_interval']
+
+def parse_value(text):
+    # JSON values, anything else is taken as a string
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def load_config(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Export the transactions of Hive accounts aggregated by day')
+    parser.add_argument('--config', help='JSON file with the parameters')
+    parser.add_argument('--accounts', nargs='+', help='accounts to export')
+    parser.add_argument('--accounts-file', help='file with one account per line')
+    parser.add_argument('--start', help='first day, e.g. 2024-01-01')
+    parser.add_argument('--end', help='last day, included')
+    parser.add_argument('--sources', help="comma separated sources in order of preference: cache, hafsql, rpc")
+    parser.add_argument('--cache-only', metavar='DIR', help='only aggregate the operations stored in this operation store')
+    parser.add_argument('--output-format', help='csv, csv.gz, csv.zst, parquet or arrow')
+    parser.add_argument('--output-dataset', help='write all accounts into this directory, partitioned by account')
+    parser.add_argument('--parity-check', action='store_true', help='compare the sources instead of exporting')
+    parser.add_argument('--metrics-file', help='write the time and counters per stage to this JSON file')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='any other parameter, SOURCE.NAME=VALUE for a backend (values are JSON or strings)')
+    parser.add_argument('--dry-run', action='store_true', help='print what would be exported and exit')
+    return parser.parse_args(argv)
+
+def settings_from_args(args):
+    # Parameters of the config file overridden by the arguments, backend sections by source name
+    settings = load_config(args.config) if args.config else {}
+    if args.accounts_file:
+        with open(args.accounts_file) as f:
+            settings['account_names'] = [line.strip() for line in f if line.strip()]
+    options = {
+        'account_names': args.accounts,
+        'start_date': args.start,
+        'end_date': args.end,
+        'sources': args.sources.split(',') if args.sources else None,
+        'output_format': args.output_format,
+        'output_dataset': args.output_dataset,
+        'parity_check': args.parity_check or None,
+        'metrics_file': args.metrics_file,
+    }
+    settings.update({k: v for k, v in options.items() if v is not None})
+    if args.cache_only:
+        settings.update(sources=['cache'], cache_dir=args.cache_only)
+    for assignment in args.set:
+        name, _, value = assignment.partition('=')
+        if '.' in name:
+            source, name = name.split('.', 1)
+            settings.setdefault(source, {})[name] = parse_value(value)
+        else:
+            settings[name] = parse_value(value)
+    for name in date_parameters:
+        if isinstance(settings.get(name), str):
+            settings[name] = datetime.fromisoformat(settings[name])
+    for name in day_parameters:
+        if isinstance(settings.get(name), (int, float)):
+            settings[name] = timedelta(days=settings[name])
+    return settings
+
+def main(argv=None):
+    args = parse_args(argv)
+    settings = settings_from_args(args)
+
+    import engine
+    engine.source_settings = {name: settings.pop(name) for name in list(settings) if name in engine.source_classes}
+    try:
+        engine.configure(**settings)
+    except ValueError as e:
+        sys.exit(f"cli.py: {e}")
+
+    if args.dry_run:
+        engine.dry_run()
+        return 0
+    return engine.main()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,346 @@
+from datetime import datetime, timedelta
+import os
+import sys
+import threading
+import time
+from export_pool import run_exports
+from aggregation import columns, amount_scale
+from transport import print_metrics
+from instrumentation import count, timed, write_report
+from output import output_filename, write_output
+
+# Exports with both backends behind one interface. Each operation type and range goes to the fastest healthy
+# source that has it, and falls back to the next one when a source fails, e.g. from an overloaded HAFSQL to the
+# account history API. Parameters of the backends themselves (database, nodes, streaming, ...) are set in
+# hive_tx_to_csv_hafsql.py and hive_tx_to_csv.py, or in source_settings. pandas and the backends are only imported
+# once they are used, see cli.py for the command line.
+
+# Set parameters
+account_names = ['account1','account2','account3']
+start_date = datetime(2024, 1, 1)
+end_date = datetime(2024, 12, 31)
+
+# Sources to use, in order of preference until their throughput is measured: 'cache', 'hafsql' and 'rpc'
+sources = ['hafsql', 'rpc']
+# Parameters of the backends by source, e.g. {'hafsql': {'streaming': True}, 'rpc': {'history_workers': 8}}
+source_settings = {}
+# Operation store the 'cache' source reads from (e.g. 'operations_hafsql'), filled by runs with operation_store_dir
+cache_dir = None
+# The range is planned in pieces of this length, so a failing source only costs the piece it failed in
+plan_interval = timedelta(days=31)
+# A failed source is left out for source_cooldown seconds, doubling while it keeps failing
+source_cooldown = 60
+max_source_cooldown = 900
+
+# The backends label some operation types differently. Rows are relabelled to the account history labels of
+# hive_tx_to_csv.py before they are aggregated, so both sources give the same groups for them.
+source_labels = {
+    'transfer_to_vesting': {'direction': 'stake'},
+    'delegate_vesting_shares': {'direction': 'delegate'},
+    'fill_vesting_withdraw': {'sender': 'staked.hive'},
+}
+
+# Number of accounts exported in parallel, processes used to aggregate them (0 aggregates in the export threads)
+# and accounts fetched together
+workers = 1
+aggregate_workers = 0
+account_batch_size = 50
+
+# Instead of exporting, fetch the range from every source and compare their daily sums. Groups that differ by more
+# than parity_tolerance are written to parity_file.
+parity_check = False
+parity_tolerance = 0.001
+parity_file = 'parity_mismatches.csv'
+
+# Output format: 'csv', 'csv.gz', 'csv.zst' (needs zstandard), 'parquet' or 'arrow' (need pyarrow)
+output_format = 'csv'
+# Write the accounts into this directory (e.g. 'transactions_dataset') as one dataset partitioned by account
+output_dataset = None
+
+# Write the time and counters per stage to this JSON file (e.g. 'export_metrics_engine.json') and in the Prometheus text format
+metrics_file = None
+prometheus_file = None
+
+class RangeUnavailable(Exception):
+    # Raised by sources that do not have a range, which is not counted as a failure
+    pass
+
+def relabel(op_type, df):
+    # Rows of a backend with the labels of source_labels
+    if op_type in source_labels and len(df):
+        return df.assign(**source_labels[op_type])
+    return df
+
+class HafsqlSource:
+    # One HAFSQL query per operation type for a batch of accounts
+    name = 'hafsql'
+    # Account-days of one operation type per second assumed until measured
+    expected_throughput = 1000
+
+    def __init__(self):
+        import hive_tx_to_csv_hafsql as backend
+        self.backend = backend
+        if self.name in source_settings:
+            backend.configure(**source_settings[self.name])
+        self.op_types = [backend.query_type(query) for query in backend.queries]
+
+    def fetch(self, account_names, op_types, start_date, end_date):
+        # Yields the transactions of each operation type by account as they are fetched
+        queries = self.backend.queries_by_type()
+        for op_type in op_types:
+            if self.backend.operation_store is not None:
+                result = self.backend.fetch_query_with_store(queries[op_type], op_type, account_names, start_date, end_date)
+            else:
+                result = self.backend.fetch_query(queries[op_type], op_type, account_names, start_date, end_date)
+            yield op_type, {a: relabel(op_type, self.backend.aggregate_transactions(t)) for a, t in result.items()}
+
+    def close(self):
+        self.backend.database.close()
+        self.backend.ratio_database.close()
+
+class RpcSource:
+    # Scans the account history once per account and range for all operation types
+    name = 'rpc'
+    expected_throughput = 10
+
+    def __init__(self):
+        import hive_tx_to_csv as backend
+        self.backend = backend
+        if self.name in source_settings:
+            backend.configure(**source_settings[self.name])
+        self.op_types = list(backend.op_mappings)
+
+    def fetch(self, account_names, op_types, start_date, end_date):
+        rows = {}
+        for a in account_names:
+            df = self.backend.get_transactions_for_account(a, start_date, end_date)
+            rows[a] = df[(df['timestamp'] >= start_date) & (df['timestamp'] <= end_date)]
+        for op_type in op_types:
+            yield op_type, {a: df.loc[df['type'] == op_type, columns] for a, df in rows.items()}
+
+    def close(self):
+        pass
+
+class CacheSource:
+    # Operations stored by earlier runs in the operation store at cache_dir, to aggregate them again without
+    # the network. Ranges the store does not cover go to the next source.
+    name = 'cache'
+    expected_throughput = 100000
+
+    def __init__(self):
+        from operation_store import OperationStore
+        self.store = OperationStore(cache_dir)
+        self.op_types = list(dict.fromkeys(t for a in account_names for t in self.store.op_types(a)))
+
+    def fetch(self, account_names, op_types, start_date, end_date):
+        for op_type in op_types:
+            if any(self.store.missing(a, [op_type], start_date, end_date) for a in account_names):
+                raise RangeUnavailable(f"{op_type} transactions from {start_date} to {end_date} are not in {cache_dir}")
+            yield op_type, {a: relabel(op_type, self.store.read(a, [op_type], start_date, end_date)[columns]) for a in account_names}
+
+    def close(self):
+        pass
+
+source_classes = {'cache': CacheSource, 'hafsql': HafsqlSource, 'rpc': RpcSource}
+
+class SourcePlanner:
+    # Sends the operation types of a range to the healthy source with the highest throughput that has them, in
+    # account-days of one operation type per second. Operation types a failing source did not deliver go to the
+    # next one, and the failed source is left out until its cooldown has passed, like the nodes of a NodePool.
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.lock = threading.Lock()
+        self.health = {s.name: {'failures': 0, 'down_until': 0, 'throughput': s.expected_throughput} for s in sources}
+
+    def _choose(self, op_type, tried):
+        with self.lock:
+            now = time.monotonic()
+            candidates = [s for s in self.sources if op_type in s.op_types and s.name not in tried]
+            up = [s for s in candidates if self.health[s.name]['down_until'] <= now]
+            if up:
+                return max(up, key=lambda s: self.health[s.name]['throughput'])
+            # Sources that are all cooling down are still tried before giving up
+            return min(candidates, key=lambda s: self.health[s.name]['down_until'], default=None)
+
+    def _report(self, source, throughput=None):
+        # throughput is None for failed fetches
+        with self.lock:
+            health = self.health[source.name]
+            if throughput is None:
+                health['failures'] += 1
+                health['down_until'] = time.monotonic() + min(source_cooldown * 2 ** (health['failures'] - 1), max_source_cooldown)
+            else:
+                health['failures'] = 0
+                health['throughput'] = 0.8 * health['throughput'] + 0.2 * throughput
+
+    def fetch(self, account_names, op_types, start_date, end_date):
+        # Transactions of the accounts as lists of DataFrames, one per operation type and source
+        results = {a: [] for a in account_names}
+        remaining = list(op_types)
+        tried = set()
+        days = max((end_date - start_date) / timedelta(days=1), 1 / 24)
+        while remaining:
+            plan = {}
+            for op_type in remaining:
+                source = self._choose(op_type, tried)
+                if source is None:
+                    raise RuntimeError(f"No source left for {op_type} transactions of {', '.join(account_names)} from {start_date} to {end_date}")
+                plan.setdefault(source, []).append(op_type)
+
+            for source, source_op_types in plan.items():
+                started = time.monotonic()
+                try:
+                    with timed('source_fetch', source.name):
+                        for op_type, result in source.fetch(account_names, source_op_types, start_date, end_date):
+                            for account, transactions in result.items():
+                                results[account].append(transactions)
+                                count('source_fetch', 'rows', len(transactions), source.name)
+                            remaining.remove(op_type)
+                except RangeUnavailable:
+                    tried.add(source.name)
+                    continue
+                except Exception as e:
+                    self._report(source)
+                    tried.add(source.name)
+                    count('source_fetch', 'fallbacks', 1, source.name)
+                    print(f"\n{source.name} failed for {', '.join(account_names)} from {start_date} to {end_date}: {e!r}. Falling back...", end="")
+                    continue
+                elapsed = max(time.monotonic() - started, 0.001)
+                self._report(source, len(account_names) * len(source_op_types) * days / elapsed)
+        return results
+
+    def close(self):
+        for source in self.sources:
+            source.close()
+
+planner = None
+planner_lock = threading.Lock()
+
+def get_planner():
+    # The sources are set up on first use, so only the backends in use are imported
+    global planner
+    with planner_lock:
+        if planner is None:
+            planner = SourcePlanner([source_classes[name]() for name in sources])
+        return planner
+
+def op_types():
+    # Operation types of all sources, in the order they are first listed
+    return list(dict.fromkeys(t for source in get_planner().sources for t in source.op_types))
+
+def plan_ranges(start_date, end_date):
+    # Splits the range into consecutive (start, end) pieces of plan_interval, both ends included
+    ranges = []
+    current = start_date
+    while current <= end_date:
+        range_end = min(current + plan_interval - timedelta(seconds=1), end_date)
+        ranges.append((current, range_end))
+        current = range_end + timedelta(seconds=1)
+    return ranges
+
+def fetch_transactions(account_names):
+    print('Fetching transactions for accounts ' + ', '.join(account_names) + '...')
+    transactions = {a: [] for a in account_names}
+    if not op_types():
+        raise RuntimeError(f"None of the sources {', '.join(sources)} has transactions of {', '.join(account_names)}")
+    for range_start, range_end in plan_ranges(start_date, end_date):
+        for account, frames in get_planner().fetch(account_names, op_types(), range_start, range_end).items():
+            transactions[account].extend(frames)
+    return transactions
+
+def aggregate_transactions(frames):
+    # Sums the transactions of all sources per day and group. The sources already summed parts of the days, which
+    # are added up in fixed point so the result does not depend on how the range was split.
+    import pandas as pd
+    frames = [df for df in frames if len(df)]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat([df[columns] for df in frames], ignore_index=True)
+    df['date'] = pd.to_datetime(df['date']).dt.normalize()
+    df['amount'] = (df['amount'].astype(float) * amount_scale).round().astype('int64')
+    df = df.groupby(columns[:-1]).sum().reset_index()
+    df['amount'] = df['amount'] / amount_scale
+    return df
+
+def get_csv_filename(account_name):
+    return f"{account_name}_transactions_{start_date.strftime('%Y%m%d')}_to_{end_date.strftime('%Y%m%d')}.csv"
+
+def write_csv(account_name, aggregated_data):
+    with timed('to_csv'):
+        filename = output_filename(get_csv_filename(account_name), output_format, output_dataset, account_name)
+        write_output(aggregated_data, filename, output_format)
+    count('to_csv', 'rows', len(aggregated_data))
+    count('to_csv', 'bytes', os.path.getsize(filename))
+    print(f"File saved as: {filename}")
+
+def check_parity(account_names, start_date, end_date):
+    # Fetches the range from every source and compares their daily sums with the first source's, on the
+    # operation types all of them have. Returns the groups that differ or that only one of them has.
+    import pandas as pd
+    sources = get_planner().sources
+    shared_types = [t for t in op_types() if all(t in s.op_types for s in sources)]
+    daily = {}
+    for source in sources:
+        print(f"Fetching {', '.join(account_names)} from {source.name}...")
+        frames = {a: [] for a in account_names}
+        for op_type, result in source.fetch(account_names, shared_types, start_date, end_date):
+            for account, transactions in result.items():
+                frames[account].append(transactions)
+        daily[source.name] = {a: aggregate_transactions(f) for a, f in frames.items()}
+
+    reference = sources[0].name
+    mismatches = []
+    for source in sources[1:]:
+        for account in account_names:
+            merged = daily[reference][account].merge(daily[source.name][account], on=columns[:-1], how='outer', suffixes=('_' + reference, '_' + source.name))
+            difference = (merged['amount_' + reference].fillna(0) - merged['amount_' + source.name].fillna(0)).abs()
+            differing = merged[difference > parity_tolerance]
+            print(f"{account}: {source.name} matches {reference} on {len(merged) - len(differing)} of {len(merged)} daily groups")
+            for op_type, n in differing['type'].value_counts().items():
+                print(f"  {op_type}: {n} groups differ")
+            mismatches.append(differing.assign(account=account))
+    if not mismatches:
+        return pd.DataFrame()
+    return pd.concat(mismatches, ignore_index=True)
+
+def configure(**settings):
+    # Sets parameters of this module, e.g. from a config file
+    for name, value in settings.items():
+        if name not in globals():
+            raise ValueError(f"Unknown parameter {name}")
+        globals()[name] = value
+
+def dry_run():
+    # Prints what a run would do without importing or connecting to any backend
+    batches = (len(account_names) + account_batch_size - 1) // max(account_batch_size, 1)
+    ranges = plan_ranges(start_date, end_date + timedelta(days=1) - timedelta(seconds=1))
+    print(f"{len(account_names)} accounts in {batches} batches, {len(ranges)} ranges from {start_date} to {end_date}")
+    print(f"Sources: {', '.join(sources)}")
+    for name, settings in source_settings.items():
+        print(f"  {name}: " + ', '.join(f"{k}={v!r}" for k, v in settings.items()))
+    for account_name in account_names:
+        filename = output_filename(get_csv_filename(account_name), output_format, output_dataset, account_name)
+        print(f"{account_name}: {filename}" + (' (exists)' if os.path.exists(filename) else ''))
+
+def main():
+    global end_date
+    end_date = end_date + timedelta(days=1) - timedelta(seconds=1)
+
+    if parity_check:
+        mismatches = check_parity(account_names, start_date, end_date)
+        if len(mismatches):
+            mismatches.to_csv(parity_file, index=False)
+            print(f"Mismatches saved as: {parity_file}")
+        get_planner().close()
+        return 1 if len(mismatches) else 0
+
+    # Aggregate the transactions of each account by date and type and export them
+    failed = run_exports(account_names, fetch_transactions, aggregate_transactions, write_csv, workers, aggregate_workers, account_batch_size)
+    get_planner().close()
+    print_metrics()
+    write_report(metrics_file, prometheus_file)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
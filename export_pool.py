@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
+import traceback
+from instrumentation import count, timed
+
+def run_exports(account_names, fetch, aggregate, write, workers=1, aggregate_workers=0, batch_size=1):
+    # Fetch the accounts in a pool of threads (the work is waiting on the network) and optionally
+    # aggregate them in a pool of processes (pandas holds the GIL). fetch gets a batch of up to
+    # batch_size accounts and returns their transactions by account. A failing batch is reported
+    # and skipped without stopping the others. Returns a dict of failed accounts and their errors.
+    aggregate_pool = None
+    if aggregate_workers > 0:
+        aggregate_pool = ProcessPoolExecutor(aggregate_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def export(batch):
+        with timed('fetch'):
+            transactions = fetch(batch)
+        for account_name in batch:
+            account_transactions = transactions.pop(account_name)
+            count('aggregate_transactions', 'rows_in', len(account_transactions))
+            # Includes the transfer to and from the process when aggregating in a pool
+            with timed('aggregate_transactions'):
+                if aggregate_pool is not None:
+                    aggregated_data = aggregate_pool.submit(aggregate, account_transactions).result()
+                else:
+                    aggregated_data = aggregate(account_transactions)
+            count('aggregate_transactions', 'rows_out', len(aggregated_data))
+            write(account_name, aggregated_data)
+
+    batch_size = max(batch_size, 1)
+    batches = [tuple(account_names[i:i+batch_size]) for i in range(0, len(account_names), batch_size)]
+    failed = {}
+    try:
+        with ThreadPoolExecutor(max(workers, 1)) as pool:
+            futures = {pool.submit(export, batch): batch for batch in batches}
+            for done, future in enumerate(as_completed(futures), 1):
+                batch = futures[future]
+                accounts = ', '.join(batch)
+                try:
+                    future.result()
+                    print(f"\n[{done}/{len(futures)}] {accounts} exported")
+                except Exception as e:
+                    for a in batch:
+                        failed[a] = e
+                    print(f"\n[{done}/{len(futures)}] {accounts} failed: {e!r}")
+                    traceback.print_exception(e)
+    finally:
+        if aggregate_pool is not None:
+            aggregate_pool.shutdown()
+
+    if failed:
+        print(f"\n{len(failed)} of {len(account_names)} accounts failed: {', '.join(failed)}")
+    return failed
@@ -1,245 +1,538 @@
-from beem import Hive
-from beem.account import Account
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
-import requests
 import json
+import os
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from export_pool import run_exports
+from incremental import covered_end_date, load_state, save_state, merge_csv
+from transport import NodePool, post_json, print_metrics
+from aggregation import columns
+from operation_store import OperationStore, store_columns
+from vests_ratios import VestsToHiveRatioCache
+from instrumentation import count, timed, timer, write_report
+from output import output_filename, write_output
 
 # Set parameters
 account_names = ['account1','account2','account3']
 start_date = datetime(2024, 1, 1)
 end_date = datetime(2024, 12, 31)
 
-# Initialize the Hive blockchain instance
-hive = Hive(node=['https://api.hive.blog','https://api.deathwing.me'])
+# Number of accounts exported in parallel, and processes used to aggregate them (0 aggregates in the export threads)
+workers = 1
+aggregate_workers = 0
+
+# Only scan operations newer than the last run and merge them into a running CSV ledger per account
+incremental = False
+
+# Keep the normalized operations in this directory (e.g. 'operations_beem') so ranges scanned before are read
+# from disk. Needs pyarrow, incremental runs don't use it.
+operation_store_dir = None
+
+# Save the position and the normalized rows of running scans in this directory (e.g. 'checkpoints') every
+# checkpoint_interval pages and when a scan fails, so a restarted scan of the same range resumes from there
+checkpoint_dir = None
+checkpoint_interval = 10
+
+# Hive nodes to scan the blockchain with
+hive_nodes = ['https://api.hive.blog','https://api.deathwing.me']
 hafsql = 'https://hafsql-sql.mahdiyari.info'
+# Account history is fetched in segments of history_page_size entries, this many at a time spread over
+# the hive_nodes (0 scans serially with beem's history_reverse)
+history_workers = 4
+
+# VESTS to HIVE ratio cache, shared by all accounts and runs (None keeps the ratios in memory only)
+ratio_cache_file = 'vests_to_hive_ratios.sqlite'
+# Number of history entries normalized together, and ratios to request per batch
+history_page_size = 1000
+ratio_batch_size = 100
+# Sample the ratio every n blocks and interpolate in between (None to look up the exact block, 28800 = 1 day)
+ratio_sample_stride = None
+# Maximum relative difference between two samples to interpolate between them, otherwise the exact block is looked up
+ratio_interpolation_tolerance = 0.0001
+
+# Output format: 'csv', 'csv.gz', 'csv.zst' (needs zstandard), 'parquet' or 'arrow' (need pyarrow). Incremental
+# exports always merge into a plain CSV ledger.
+output_format = 'csv'
+# Write the accounts into this directory (e.g. 'transactions_dataset') as one dataset partitioned by account
+output_dataset = None
+
+# Write the time and counters per stage to this JSON file (e.g. 'export_metrics.json') and in the Prometheus text format
+metrics_file = None
+prometheus_file = None
+
+def nai_currency(asset):
+    return 'HIVE' if asset['nai'] == '@@000000021' else 'HBD'
+
+def other_currency(asset):
+    return 'HBD' if asset['nai'] == '@@000000021' else 'HIVE'
 
+# Operations to exclude (not working with history_reverse, needs to be filtered after fetching)
+excluded = ['transfer_to_savings','transfer_from_savings','cancel_transfer_from_savings','claim_account','proxy_cleared','create_claimed_account','account_created','witness_update','account_update','witness_set_properties','vote','effective_comment_vote','account_witness_vote','comment','claim_reward_balance','update_proposal_votes','custom_json','comment_reward','comment_payout_update','comment_options','withdraw_vesting','delayed_voting','limit_order_create','limit_order_cancelled']
+
+# Transactions produced by each operation type, one entry per (date, type, direction, sender, recipient, currency, amount) row.
+# 'amount' names the asset field and 'scale' how it is converted: 'asset' by its precision, 'milli' by 1000 and 'vests'
+# to HP with the VESTS to HIVE ratio of the block. The other fields are fixed values or functions of the operation and
+# the account, and rows are only produced if 'when' (if given) is true.
+op_mappings = {
+    'transfer': [
+        {'amount': 'amount', 'scale': 'asset', 'currency': lambda h, a: nai_currency(h['amount']),
+         'direction': lambda h, a: 'incoming' if h['to'] == a else 'outgoing', 'sender': lambda h, a: h['from'], 'recipient': lambda h, a: h['to']},
+    ],
+    'interest': [
+        {'amount': 'interest', 'scale': 'asset', 'currency': 'HBD', 'direction': 'incoming', 'sender': 'hive.rewards', 'recipient': lambda h, a: h['owner']},
+    ],
+    'fill_vesting_withdraw': [
+        {'amount': 'deposited', 'scale': 'asset', 'currency': 'HIVE', 'direction': 'unstake', 'sender': 'staked.hive', 'recipient': lambda h, a: h['to_account']},
+    ],
+    'curation_reward': [
+        {'amount': 'reward', 'scale': 'vests', 'currency': 'HP', 'direction': 'incoming', 'sender': 'hive.rewards', 'recipient': lambda h, a: a},
+    ],
+    'producer_reward': [
+        {'amount': 'vesting_shares', 'scale': 'vests', 'currency': 'HP', 'direction': 'incoming', 'sender': 'hive.rewards', 'recipient': lambda h, a: a},
+    ],
+    'fill_convert_request': [
+        {'amount': 'amount_out', 'scale': 'asset', 'currency': 'HIVE', 'direction': 'incoming', 'sender': lambda h, a: h['owner'], 'recipient': lambda h, a: h['account']},
+    ],
+    'convert': [
+        {'amount': 'amount', 'scale': 'asset', 'currency': 'HBD', 'direction': 'outgoing', 'sender': lambda h, a: h['owner'], 'recipient': lambda h, a: h['account']},
+    ],
+    'comment_benefactor_reward': [
+        {'amount': 'hbd_payout', 'scale': 'milli', 'currency': 'HBD', 'direction': 'incoming', 'sender': 'hive.rewards', 'recipient': lambda h, a: h['benefactor']},
+        {'amount': 'hive_payout', 'scale': 'milli', 'currency': 'HIVE', 'direction': 'incoming', 'sender': 'hive.rewards', 'recipient': lambda h, a: h['benefactor']},
+        {'amount': 'vesting_payout', 'scale': 'vests', 'currency': 'HP', 'direction': 'incoming', 'sender': 'hive.rewards', 'recipient': lambda h, a: h['benefactor']},
+    ],
+    'author_reward': [
+        {'amount': 'hbd_payout', 'scale': 'milli', 'currency': 'HBD', 'direction': 'incoming', 'sender': 'hive.rewards', 'recipient': lambda h, a: h['author']},
+        {'amount': 'hive_payout', 'scale': 'milli', 'currency': 'HIVE', 'direction': 'incoming', 'sender': 'hive.rewards', 'recipient': lambda h, a: h['author']},
+        {'amount': 'vesting_payout', 'scale': 'vests', 'currency': 'HP', 'direction': 'incoming', 'sender': 'hive.rewards', 'recipient': lambda h, a: h['author']},
+    ],
+    'fill_order': [
+        {'when': lambda h, a: h['current_owner'] == a,
+         'amount': 'current_pays', 'scale': 'milli', 'currency': lambda h, a: nai_currency(h['current_pays']), 'direction': 'outgoing', 'sender': lambda h, a: h['current_owner'], 'recipient': 'hive.market'},
+        {'when': lambda h, a: h['current_owner'] == a,
+         'amount': 'open_pays', 'scale': 'milli', 'currency': lambda h, a: other_currency(h['current_pays']), 'direction': 'incoming', 'sender': 'hive.market', 'recipient': lambda h, a: h['current_owner']},
+        {'when': lambda h, a: h['current_owner'] != a and h['open_owner'] == a,
+         'amount': 'current_pays', 'scale': 'milli', 'currency': lambda h, a: nai_currency(h['current_pays']), 'direction': 'incoming', 'sender': 'hive.market', 'recipient': lambda h, a: h['open_owner']},
+        {'when': lambda h, a: h['current_owner'] != a and h['open_owner'] == a,
+         'amount': 'open_pays', 'scale': 'milli', 'currency': lambda h, a: other_currency(h['current_pays']), 'direction': 'outgoing', 'sender': lambda h, a: h['open_owner'], 'recipient': 'hive.market'},
+    ],
+    'proposal_pay': [
+        {'amount': 'payment', 'scale': 'asset', 'currency': 'HBD', 'direction': 'incoming', 'sender': lambda h, a: h['payer'], 'recipient': lambda h, a: h['receiver']},
+    ],
+    'transfer_to_vesting': [
+        {'amount': 'amount', 'scale': 'asset', 'currency': 'HIVE', 'direction': 'stake', 'sender': lambda h, a: h['from'], 'recipient': 'staked.hive'},
+    ],
+    'delegate_vesting_shares': [
+        {'amount': 'vesting_shares', 'scale': 'vests', 'currency': 'HP', 'direction': 'delegate', 'sender': lambda h, a: h['delegator'], 'recipient': lambda h, a: h['delegatee']},
+    ],
+    'return_vesting_delegation': [
+        {'amount': 'vesting_shares', 'scale': 'vests', 'currency': 'HP', 'direction': 'undelegate', 'sender': 'delegated.hive', 'recipient': lambda h, a: h['account']},
+    ],
+}
+
+# Operations with amounts in VESTS, which need the VESTS to HIVE ratio
+vests_ops = [op for op, legs in op_mappings.items() if any(leg['scale'] == 'vests' for leg in legs)]
+
+hive_local = threading.local()
+
+def get_hive():
+    # Initialize the Hive blockchain instance, beem is not thread safe so each export thread gets its own.
+    # beem is only imported for serial scans, it takes seconds to load.
+    if not hasattr(hive_local, 'hive'):
+        from beem import Hive
+        hive_local.hive = Hive(node=hive_nodes)
+    return hive_local.hive
+
+def get_account(account_name):
+    from beem.account import Account
+    return Account(account_name, blockchain_instance=get_hive())
+
+def calculate_vests_to_hive_ratio(global_properties):
+    total_vesting_fund_hive = float(global_properties['total_vesting_fund_hive'])
+    total_vesting_shares = float(global_properties['total_vesting_shares'])
+    
+    return total_vesting_fund_hive / total_vesting_shares
+
+@timer('ratio_lookup')
 def get_vests_to_hive_ratio(block_num):
+    count('ratio_lookup', 'blocks')
     headers = {
         'Content-Type': 'application/x-www-form-urlencoded',
     }
 
     data = '{"jsonrpc":"2.0", "method":"hafsql.dynamic_global_properties", "params":{"block_num": '+str(block_num)+'}, "id":1}'
-    response = 0
-    while response == 0:
-        try:
-            response = requests.post(hafsql, headers=headers, data=data)
-            global_properties = json.loads(response.text)['result'][0]
-        except:
-            response = 0
+    response = post_json(hafsql, data, headers)
+    if not response.get('result'):
+        raise RuntimeError(f"No global properties for block {block_num}")
+    global_properties = response['result'][0]
     
     # Calculate VESTS to HIVE ratio
-    total_vesting_fund_hive = float(global_properties['total_vesting_fund_hive'])
-    total_vesting_shares = float(global_properties['total_vesting_shares'])
-    
-    return total_vesting_fund_hive / total_vesting_shares
+    return calculate_vests_to_hive_ratio(global_properties)
+
+@timer('ratio_lookup')
+def get_vests_to_hive_ratios(block_nums):
+    # Request the ratios for several blocks in one JSON-RPC batch, blocks missing from the result are left out
+    count('ratio_lookup', 'blocks', len(block_nums))
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded',
+    }
+
+    data = json.dumps([{"jsonrpc":"2.0", "method":"hafsql.dynamic_global_properties", "params":{"block_num": b}, "id":b} for b in block_nums])
+    try:
+        results = post_json(hafsql, data, headers, retry_rpc_errors=False)
+    except Exception:
+        return {}
+
+    ratios = {}
+    if isinstance(results, list):
+        for r in results:
+            if isinstance(r, dict) and r.get('result'):
+                ratios[r['id']] = calculate_vests_to_hive_ratio(r['result'][0])
+    return ratios
+
+ratio_cache = None
+ratio_cache_lock = threading.Lock()
+
+def get_ratio_cache():
+    # Opened on first use, so importing this module does not create the cache file
+    global ratio_cache
+    with ratio_cache_lock:
+        if ratio_cache is None:
+            ratio_cache = VestsToHiveRatioCache(get_vests_to_hive_ratios, get_vests_to_hive_ratio, ratio_cache_file, ratio_batch_size, ratio_sample_stride, ratio_interpolation_tolerance)
+        return ratio_cache
+
+operation_store = OperationStore(operation_store_dir) if operation_store_dir else None
+node_pool = NodePool(hive_nodes)
+
+def configure(**settings):
+    # Sets parameters of this module, e.g. from a config file, and rebuilds the objects made from them
+    global ratio_cache, operation_store, node_pool
+    for name, value in settings.items():
+        if name not in globals():
+            raise ValueError(f"Unknown parameter {name}")
+        globals()[name] = value
+    ratio_cache = None
+    operation_store = OperationStore(operation_store_dir) if operation_store_dir else None
+    node_pool = NodePool(hive_nodes)
+
+def paginate(iterable, size):
+    page = []
+    for item in iterable:
+        page.append(item)
+        if len(page) >= size:
+            yield page
+            page = []
+    if page:
+        yield page
 
-def get_transactions_for_account(account_name, start_date, end_date):
+@timer('account_history')
+def get_account_history(account_name, start, limit):
+    # History entries up to index start (-1 for the newest), oldest first and in the format of beem's history
+    result = node_pool.call('account_history_api.get_account_history', {'account': account_name, 'start': start, 'limit': limit})
+    history = []
+    count('account_history', 'entries', len(result['history']))
+    for index, entry in result['history']:
+        h = dict(entry['op']['value'])
+        h['type'] = entry['op']['type'].removesuffix('_operation')
+        h['index'] = index
+        h['block'] = entry['block']
+        h['timestamp'] = entry['timestamp']
+        history.append(h)
+    return history
+
+def history_position(h, bound):
+    # Position of an entry comparable to a date or block number bound
+    return h['block'] if isinstance(bound, int) else datetime.fromisoformat(h['timestamp'])
+
+def find_history_index(account_name, bound, lo, hi, after, executor):
+    # First index in [lo, hi] past the bound (or at it unless after), hi + 1 if there is none. The range is
+    # narrowed down with history_workers concurrent probes until the rest fits in one segment.
+    def past(h):
+        position = history_position(h, bound)
+        return position > bound or (position == bound and not after)
+
+    while hi - lo + 1 > history_page_size:
+        step = (hi - lo + 1) / (history_workers + 1)
+        probes = sorted({lo + int(step * (i + 1)) for i in range(history_workers)})
+        entries = executor.map(lambda i: get_account_history(account_name, i, 1)[-1], probes)
+        for probe, h in zip(probes, entries):
+            if past(h):
+                hi = probe - 1
+                break
+            lo = probe + 1
+    if lo <= hi:
+        for h in get_account_history(account_name, hi, hi - lo + 1):
+            if lo <= h['index'] <= hi and past(h):
+                return h['index']
+    return hi + 1
+
+def resolve_history_bounds(account_name, start_date, end_date, executor):
+    # First and last history index between start_date (a date or block number) and end_date, None if there are none
+    newest = get_account_history(account_name, -1, 1)
+    if not newest:
+        return None
+    last_index = newest[-1]['index']
+    first = find_history_index(account_name, start_date, 0, last_index, False, executor)
+    last = find_history_index(account_name, end_date, first, last_index, True, executor) - 1
+    if first > last:
+        return None
+    return first, last
+
+def fetch_history_segment(account_name, first, last):
+    # The VESTS to HIVE ratios of the segment are prefetched in the same worker
+    history = [h for h in get_account_history(account_name, last, last - first + 1) if first <= h['index'] <= last]
+    get_ratio_cache().prefetch(h['block'] for h in history if h['type'] in vests_ops)
+    return history
+
+def fetch_history(account_name, start_date, end_date):
+    # Yields the history between start_date and end_date newest first, like history_reverse. The index range
+    # is split into segments that are fetched concurrently from the nodes and reassembled in order, with a
+    # bounded number of segments ahead of the one being consumed.
+    with ThreadPoolExecutor(history_workers) as executor:
+        bounds = resolve_history_bounds(account_name, start_date, end_date, executor)
+        if bounds is None:
+            return
+        first, last = bounds
+        segments = iter([(max(first, s - history_page_size + 1), s) for s in range(last, first - 1, -history_page_size)])
+        pending = deque()
+        for segment in segments:
+            pending.append(executor.submit(fetch_history_segment, account_name, *segment))
+            if len(pending) >= 2 * history_workers:
+                break
+        while pending:
+            history = pending.popleft().result()
+            segment = next(segments, None)
+            if segment is not None:
+                pending.append(executor.submit(fetch_history_segment, account_name, *segment))
+            yield from reversed(history)
+
+def field(spec, h, account_name):
+    return spec(h, account_name) if callable(spec) else spec
+
+def normalize_history(page, account_name):
+    # Turns a page of account history into a DataFrame of transactions. Values are collected per column
+    # with the op_mappings, then timestamps and amounts are converted for the whole page at once.
+    values = {c: [] for c in ['timestamp', 'id', 'type', 'direction', 'sender', 'recipient', 'currency', 'raw_amount', 'precision', 'ratio']}
+    ratio_cache = get_ratio_cache()
+    for h in page:
+        legs = op_mappings.get(h['type'])
+        if legs is None:
+            if h['type'] not in excluded:
+                print(h)
+            continue
+        for leg in legs:
+            if 'when' in leg and not leg['when'](h, account_name):
+                continue
+            asset = h[leg['amount']]
+            values['timestamp'].append(h['timestamp'])
+            values['id'].append(h['index'])
+            values['type'].append(h['type'])
+            values['direction'].append(field(leg['direction'], h, account_name))
+            values['sender'].append(field(leg['sender'], h, account_name))
+            values['recipient'].append(field(leg['recipient'], h, account_name))
+            values['currency'].append(field(leg['currency'], h, account_name))
+            values['raw_amount'].append(asset['amount'])
+            values['precision'].append(asset['precision'] if leg['scale'] == 'asset' else 3)
+            values['ratio'].append(ratio_cache.get(h['block']) if leg['scale'] == 'vests' else np.nan)
+
+    raw_amount = np.array(values['raw_amount'], dtype=np.float64)
+    ratio = np.array(values['ratio'], dtype=np.float64)
+    precision = np.array(values['precision'], dtype=np.float64)
+    amount = np.where(np.isnan(ratio), raw_amount / 10**precision, np.round(raw_amount * ratio / 1000, 3))
+    timestamp = pd.to_datetime(pd.Series(values['timestamp'], dtype=object), format='ISO8601')
+    df = pd.DataFrame({
+        'timestamp': timestamp,
+        'id': values['id'],
+        'date': timestamp.dt.normalize(),
+        'type': values['type'],
+        'direction': values['direction'],
+        'sender': values['sender'],
+        'recipient': values['recipient'],
+        'currency': values['currency'],
+        'amount': amount,
+    })
+    return df[df['amount'] > 0]
+
+def checkpoint_path(name):
+    return os.path.join(checkpoint_dir, name)
+
+def load_checkpoint(account_name, start_date, end_date):
+    # Checkpoint of an interrupted scan of the same range, None if there is none
+    if not checkpoint_dir or not os.path.exists(checkpoint_path(f"{account_name}.checkpoint.json")):
+        return None
+    with open(checkpoint_path(f"{account_name}.checkpoint.json")) as f:
+        checkpoint = json.load(f)
+    if checkpoint['range'] != [str(start_date), str(end_date)]:
+        return None
+    return checkpoint
+
+def save_checkpoint(account_name, checkpoint, rows):
+    # Stores the rows scanned since the last checkpoint as a new part, then moves the position
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    if rows:
+        part = f"{account_name}.checkpoint.{len(checkpoint['parts'])}.pkl"
+        pd.concat(rows, ignore_index=True).to_pickle(checkpoint_path(part))
+        checkpoint['parts'].append(part)
+    filename = checkpoint_path(f"{account_name}.checkpoint.json")
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+def remove_checkpoint(account_name, checkpoint):
+    for part in checkpoint['parts']:
+        os.remove(checkpoint_path(part))
+    if os.path.exists(checkpoint_path(f"{account_name}.checkpoint.json")):
+        os.remove(checkpoint_path(f"{account_name}.checkpoint.json"))
+
+def scan_history(account_name, start_date, end_date, state=None):
+    # start_date can also be a block number. If a state is given, operations up to its last_index are
+    # skipped and it is updated with the newest operation scanned.
     print('Scanning transactions for account '+account_name+'...')
 
-    account = Account(account_name, blockchain_instance=hive)
-    
-    # List to hold transaction data
+    # DataFrames to hold transaction data per page
     transactions = []
-
-   # Operations to include/exclude (not working with history_reverse, needs to be filtered in loop)
-    ops = ['interest','return_vesting_delegation','delegate_vesting_shares','transfer_to_vesting','proposal_pay','fill_order','author_reward','comment_benefactor_reward','convert','fill_convert_request','producer_reward','curation_reward','fill_vesting_withdraw','transfer']
-    excluded = ['transfer_to_savings','transfer_from_savings','cancel_transfer_from_savings','claim_account','proxy_cleared','create_claimed_account','account_created','witness_update','account_update','witness_set_properties','vote','effective_comment_vote','account_witness_vote','comment','claim_reward_balance','update_proposal_votes','custom_json','comment_reward','comment_payout_update','comment_options','withdraw_vesting','delayed_voting','limit_order_create','limit_order_cancelled']
-       
-    # Iterate over account history
     scanned_tx = 0
-    last_ratio_update = 0
-    for h in account.history_reverse(stop=start_date,start=end_date):
-        scanned_tx = scanned_tx + 1
-        if scanned_tx%100 == 0:
-            print('scanned '+str(scanned_tx)+' transactions ('+h['timestamp']+')')
-
-        timestamp = h['timestamp'].replace('T', ' ')
-        tx_time = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-
-        # Get block number from transaction
-        block_num = h['block']
-
-        # Filter monetary transactions and witness rewards
-        if h['type'] not in excluded:
-
-            # Get VESTS to HIVE ratio at the time of the transaction
-            if last_ratio_update != block_num:            
-                vests_to_hive_ratio = get_vests_to_hive_ratio(block_num)
-                last_ratio_update = block_num
-            
-            # Determine the currency and amount
-            currency = None
-            amount = 0
-            sender = None
-            recipient = None
-            direction = None
-            
-            # Transfer
-            if h['type'] == 'transfer':
-                if h['amount']['nai'] == '@@000000021':
-                    currency = 'HIVE'
-                else:
-                    currency = 'HBD'
-                amount = int(h['amount']['amount']) / 10**h['amount']['precision']
-                sender = h['from']
-                recipient = h['to']
-                direction = 'incoming' if recipient == account_name else 'outgoing'
-
-            # Interest
-            elif h['type'] == 'interest':
-                currency = 'HBD'
-                amount = int(h['interest']['amount']) / 10**h['interest']['precision']
-                sender = 'hive.rewards'
-                recipient = h['owner']
-                direction = 'incoming'
-
-            # Fill vesting withdraw
-            elif h['type'] == 'fill_vesting_withdraw':
-                currency = 'HIVE'
-                amount = int(h['deposited']['amount']) / 10**h['deposited']['precision']
-                sender = 'staked.hive'
-                recipient = h['to_account']
-                direction = 'unstake'
-            
-            # Curation Reward
-            elif h['type'] == 'curation_reward':
-                vesting_amount = float(h['reward']['amount'])
-                hive_amount = round(vesting_amount * vests_to_hive_ratio / 1000,3)
-                currency = 'HP'
-                amount = hive_amount
-                sender = 'hive.rewards'
-                recipient = account_name
-                direction = 'incoming'
-
-            # Witness Producer Reward
-            elif h['type'] == 'producer_reward':
-                vesting_amount = float(h['vesting_shares']['amount'])
-                hive_amount = round(vesting_amount * vests_to_hive_ratio / 1000,3)
-                currency = 'HP'
-                amount = hive_amount
-                sender = 'hive.rewards'
-                recipient = account_name
-                direction = 'incoming'
-
-            # Fill convert request
-            elif h['type'] == 'fill_convert_request':
-                currency = 'HIVE'
-                amount = int(h['amount_out']['amount']) / 10**h['amount_out']['precision']
-                sender = h['owner']
-                recipient = h['account']
-                direction = 'incoming'
-
-            # Convert request
-            elif h['type'] == 'convert':
-                currency = 'HBD'
-                amount = int(h['amount']['amount']) / 10**h['amount']['precision']
-                sender = h['owner']
-                recipient = h['account']
-                direction = 'outgoing'
-
-            # Comment benefactor reward
-            elif h['type'] == 'comment_benefactor_reward':
-                if int(h['hbd_payout']['amount']) > 0:
-                    transactions.append((tx_time.date(), h['type'], 'incoming', 'hive.rewards', h['benefactor'], 'HBD', int(h['hbd_payout']['amount'])/1000))
-                if int(h['hive_payout']['amount']) > 0:
-                    transactions.append((tx_time.date(), h['type'], 'incoming', 'hive.rewards', h['benefactor'], 'HIVE', int(h['hive_payout']['amount'])/1000))
-                if float(h['vesting_payout']['amount']) > 0:
-                    hp_amount = round(int(h['vesting_payout']['amount']) * vests_to_hive_ratio / 1000,3)
-                    transactions.append((tx_time.date(), h['type'], 'incoming', 'hive.rewards', h['benefactor'], 'HP', hp_amount))
-                continue
-            
-            # Author Reward
-            elif h['type'] == 'author_reward':
-                if int(h['hbd_payout']['amount']) > 0:
-                    transactions.append((tx_time.date(), h['type'], 'incoming', 'hive.rewards', h['author'], 'HBD', int(h['hbd_payout']['amount'])/1000))
-                if int(h['hive_payout']['amount']) > 0:
-                    transactions.append((tx_time.date(), h['type'], 'incoming', 'hive.rewards', h['author'], 'HIVE', int(h['hive_payout']['amount'])/1000))
-                if float(h['vesting_payout']['amount']) > 0:
-                    hp_amount = round(int(h['vesting_payout']['amount']) * vests_to_hive_ratio / 1000,3)
-                    transactions.append((tx_time.date(), h['type'], 'incoming', 'hive.rewards', h['author'], 'HP', hp_amount))
-                continue
+    new_state = None
+
+    # Resume below the oldest operation of the last checkpoint
+    scan_end = end_date
+    checkpoint = load_checkpoint(account_name, start_date, end_date)
+    if checkpoint is not None:
+        transactions = [pd.read_pickle(checkpoint_path(part)) for part in checkpoint['parts']]
+        scanned_tx = checkpoint['scanned']
+        new_state = checkpoint['new_state']
+        scan_end = datetime.fromisoformat(checkpoint['last_timestamp'])
+        print(account_name+': resuming after '+str(scanned_tx)+' transactions ('+checkpoint['last_timestamp']+')')
+    else:
+        checkpoint = {'range': [str(start_date), str(end_date)], 'parts': [], 'scanned': 0, 'new_state': None, 'last_index': None, 'last_block': None, 'last_timestamp': None}
+    saved = len(transactions)
+
+    if history_workers:
+        history = fetch_history(account_name, start_date, scan_end)
+    else:
+        account = get_account(account_name)
+        history = account.history_reverse(stop=start_date,start=scan_end)
 
-            # Fill order
-            elif h['type'] == 'fill_order':
-                if h['current_pays']['nai']  == '@@000000021':
-                    current_currency = 'HIVE'
-                    open_currency = 'HBD'
-                elif h['current_pays']['nai'] == '@@000000013':
-                    current_currency = 'HBD'
-                    open_currency = 'HIVE'
-                if h['current_owner'] == account_name:
-                    transactions.append((tx_time.date(), h['type'], 'outgoing', h['current_owner'], 'hive.market', current_currency, int(h['current_pays']['amount'])/1000))
-                    transactions.append((tx_time.date(), h['type'], 'incoming', 'hive.market', h['current_owner'], open_currency, int(h['open_pays']['amount'])/1000))
-                elif h['open_owner'] == account_name:
-                    transactions.append((tx_time.date(), h['type'], 'incoming', 'hive.market', h['open_owner'], current_currency, int(h['current_pays']['amount'])/1000))
-                    transactions.append((tx_time.date(), h['type'], 'outgoing', h['open_owner'], 'hive.market', open_currency, int(h['open_pays']['amount'])/1000))
+    # Iterate over account history in pages, prefetching the VESTS to HIVE ratios in batches
+    try:
+        for pages, page in enumerate(paginate(history, history_page_size), 1):
+            if checkpoint['last_index'] is not None:
+                page = [h for h in page if h['index'] < checkpoint['last_index']]
+            if state is not None and state.get('last_index') is not None:
+                page = [h for h in page if h['index'] > state['last_index']]
+            if not page:
                 continue
+            if state is not None and scanned_tx == 0:
+                new_state = {'last_index': page[0]['index'], 'last_block': page[0]['block']}
 
-            # Proposal pay
-            elif h['type'] == 'proposal_pay':
-                currency = 'HBD'
-                amount = int(h['payment']['amount']) / 10**h['payment']['precision']
-                sender = h['payer']
-                recipient = h['receiver']
-                direction = 'incoming'
-
-            # Power up
-            elif h['type'] == 'transfer_to_vesting':
-                currency = 'HIVE'
-                amount = int(h['amount']['amount']) / 10**h['amount']['precision']
-                sender = h['from']
-                recipient = 'staked.hive'
-                direction = 'stake'
-
-            # Delegate HP
-            elif h['type'] == 'delegate_vesting_shares':
-                currency = 'HP'
-                vesting_amount = float(h['vesting_shares']['amount'])
-                amount = round(vesting_amount * vests_to_hive_ratio / 1000,3)
-                sender = h['delegator']
-                recipient = h['delegatee']
-                direction = 'delegate'
-
-            # Undelegate HP
-            elif h['type'] == 'return_vesting_delegation':
-                currency = 'HP'
-                vesting_amount = float(h['vesting_shares']['amount'])
-                amount = round(vesting_amount * vests_to_hive_ratio / 1000,3)
-                sender = 'delegated.hive'
-                recipient = h['account']
-                direction = 'undelegate'
-
-            else:
-                print(h)
-            
-            # Append data as (date, type, direction, sender, recipient, currency, amount)
-            if currency and amount > 0:
-                transactions.append((tx_time.date(), h['type'], direction, sender, recipient, currency, amount))
-    
-    return transactions
+            scanned_tx = scanned_tx + len(page)
+            print(account_name+': scanned '+str(scanned_tx)+' transactions ('+page[-1]['timestamp']+')')
+
+            get_ratio_cache().prefetch(h['block'] for h in page if h['type'] in vests_ops)
+            with timed('normalize_history'):
+                rows = normalize_history(page, account_name)
+            count('normalize_history', 'entries', len(page))
+            for op_type, n in rows['type'].value_counts().items():
+                count('normalize_history', 'rows', n, op_type)
+            transactions.append(rows)
+            checkpoint.update(scanned=scanned_tx, new_state=new_state, last_index=page[-1]['index'], last_block=page[-1]['block'], last_timestamp=page[-1]['timestamp'])
+
+            if checkpoint_dir and pages % checkpoint_interval == 0:
+                save_checkpoint(account_name, checkpoint, transactions[saved:])
+                saved = len(transactions)
+    except BaseException:
+        if checkpoint_dir and checkpoint['last_index'] is not None:
+            save_checkpoint(account_name, checkpoint, transactions[saved:])
+            print(account_name+': checkpoint saved after '+str(checkpoint['scanned'])+' transactions')
+        raise
+
+    if checkpoint_dir:
+        remove_checkpoint(account_name, checkpoint)
+
+    if state is not None and new_state is not None:
+        state.update(new_state)
+
+    if not transactions:
+        return pd.DataFrame(columns=store_columns)
+    return pd.concat(transactions, ignore_index=True)
+
+def get_transactions_for_account(account_name, start_date, end_date, state=None):
+    # Scans the history of the account, or only the parts of the range missing from the operation store
+    if operation_store is None or state is not None:
+        return scan_history(account_name, start_date, end_date, state)
+
+    for range_start, range_end in operation_store.missing(account_name, op_mappings, start_date, end_date):
+        rows = scan_history(account_name, range_start, range_end)
+        rows = rows[(rows['timestamp'] >= range_start) & (rows['timestamp'] <= range_end)]
+        for op_type in op_mappings:
+            operation_store.write(account_name, op_type, rows[rows['type'] == op_type], range_start, range_end)
+    return operation_store.read(account_name, op_mappings, start_date, end_date)
 
 def aggregate_transactions(transactions):
     # Create DataFrame
-    df = pd.DataFrame(transactions, columns=['date', 'type', 'direction', 'sender', 'recipient', 'currency', 'amount'])
+    df = pd.DataFrame(transactions, columns=columns)
     
     # Aggregate by date, type, direction, currency, sender, and recipient
     aggregated_df = df.groupby(['date', 'type', 'direction', 'sender', 'recipient', 'currency']).sum().reset_index()
     
     return aggregated_df
 
-end_date = end_date + timedelta(days=1) - timedelta(seconds=1)
-for a in account_names:
+# New high-water marks of incremental exports, saved once their CSV is written
+high_water_marks = {}
 
-	# Get transactions for the given account and time range
-	transactions = get_transactions_for_account(a, start_date, end_date)
+def get_csv_filename(account_name):
+    if incremental:
+        return f"{account_name}_transactions_{start_date.strftime('%Y%m%d')}_ledger.csv"
+    return f"{account_name}_transactions_{start_date.strftime('%Y%m%d')}_to_{end_date.strftime('%Y%m%d')}.csv"
+
+def fetch_transactions(account_names):
+    # Get transactions for the given accounts and time range, or since the last run when exporting incrementally
+    transactions = {}
+    for a in account_names:
+        if not incremental:
+            transactions[a] = get_transactions_for_account(a, start_date, end_date)
+            continue
+        fetch_end = covered_end_date(end_date)
+        state = load_state(get_csv_filename(a))
+        if state is None:
+            state = {'last_index': None, 'last_block': None}
+            transactions[a] = get_transactions_for_account(a, start_date, fetch_end, state)
+        elif state['end_date'] >= fetch_end:
+            print(f"{a}: already exported up to {state['end_date']}")
+            transactions[a] = []
+        else:
+            stop = state['last_block'] if state['last_block'] is not None else state['end_date']
+            transactions[a] = get_transactions_for_account(a, stop, fetch_end, state)
+        high_water_marks[a] = dict(state, end_date=max(state.get('end_date', fetch_end), fetch_end))
+    return transactions
 
-	# Aggregate the transactions by date and type
-	aggregated_data = aggregate_transactions(transactions)
+def write_csv(account_name, aggregated_data):
+    csv_filename = get_csv_filename(account_name)
+    with timed('to_csv'):
+        if incremental:
+            # Merge into the existing ledger, then move the high-water mark
+            filename = csv_filename
+            merge_csv(csv_filename, aggregated_data)
+            save_state(csv_filename, high_water_marks.pop(account_name))
+        else:
+            # Export in the output format, the file appears once it is complete
+            filename = output_filename(csv_filename, output_format, output_dataset, account_name)
+            write_output(aggregated_data, filename, output_format)
+    count('to_csv', 'rows', len(aggregated_data))
+    count('to_csv', 'bytes', os.path.getsize(filename))
 
-	# Export to CSV
-	csv_filename = f"{a}_transactions_{start_date.strftime('%Y%m%d')}_to_{end_date.strftime('%Y%m%d')}.csv"
-	aggregated_data.to_csv(csv_filename, index=False)
+    print(f"File saved as: {filename}")
 
-	print(f"CSV file saved as: {csv_filename}")
+if __name__ == '__main__':
+    end_date = end_date + timedelta(days=1) - timedelta(seconds=1)
 
+    # Get transactions for the given accounts and time range, aggregate them by date and type and write them to CSV
+    failed = run_exports(account_names, fetch_transactions, aggregate_transactions, write_csv, workers, aggregate_workers)
+    print_metrics()
+    write_report(metrics_file, prometheus_file)
+    if failed:
+        sys.exit(1)
@@ -1,14 +1,83 @@
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
-import psycopg2
-from psycopg2 import OperationalError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import os
 import sys
+import threading
+import time
+from itertools import islice
+from export_pool import run_exports
+from aggregation import TransactionAggregator, TransactionColumns, columns
+from incremental import covered_end_date, load_state, save_state, merge_csv
+from transport import DatabasePool, print_metrics
+from operation_store import OperationStore, merge_ranges
+from vests_ratios import VestsToHiveRatioCache
+from operation_ids import OperationIdPlanner
+from instrumentation import count, timed, timer, write_report
+from output import output_filename, write_output
 
 # Set parameters
 account_names = ['account1','account2','account3']
 start_date = datetime(2024, 1, 1)
 end_date = datetime(2024, 12, 31)
 
+# Number of accounts exported in parallel, and processes used to aggregate them (0 aggregates in the export threads)
+workers = 1
+aggregate_workers = 0
+# Number of accounts fetched together with one query per operation type
+account_batch_size = 50
+
+# Only fetch operations newer than the last run and merge them into a running CSV ledger per account
+incremental = False
+
+# Stream rows from server side cursors in chunks of stream_itersize and aggregate them on the fly,
+# keeping memory flat for accounts with millions of operations. Only the sums per day are kept, so the
+# CSV has one row per day and group instead of one per timestamp.
+streaming = False
+stream_itersize = 10000
+
+# Sum the transactions per day and group in the queries, so only the daily sums are transferred. Not used by
+# incremental exports after the first run and the operation store, which need the individual operations.
+# The rows fetched without it are then summed per day too, so incremental ledgers stay daily. Without
+# server_aggregation, streaming or day_buckets the rows are summed per operation timestamp instead, and an
+# incremental ledger should keep the same settings for all its runs so it doesn't mix both.
+server_aggregation = False
+
+# Fetch VESTS amounts with their block and convert them to HP client side with one ratio lookup per distinct
+# block, instead of calling hafsql.vests_to_hive for every row. Reward tables are scanned once for their HBD,
+# HIVE and VESTS payouts. Not used with server_aggregation, which needs the HP amounts in the queries.
+client_vests_conversion = False
+# Ratios are cached in this file (None keeps them in memory only), in HIVE per VESTS
+ratio_cache_file = 'vests_to_hive_ratios_hafsql.sqlite'
+# Rows converted together, ratios requested per query, and the sampling of the ratios as in the beem exporter
+vests_batch_size = 10000
+ratio_batch_size = 1000
+ratio_sample_stride = None
+ratio_interpolation_tolerance = 0.0001
+
+# Date rows by the day their operation id falls in, from the ids of the midnights resolved once per day, instead
+# of calling hafsql.get_timestamp for every row. Rows are then dated by day like in the beem exporter.
+day_buckets = False
+# Rows dated together
+day_batch_size = 10000
+
+# Output format: 'csv', 'csv.gz', 'csv.zst' (needs zstandard), 'parquet' or 'arrow' (need pyarrow). Incremental
+# exports always merge into a plain CSV ledger.
+output_format = 'csv'
+# Write the accounts into this directory (e.g. 'transactions_dataset_hafsql') as one dataset partitioned by account
+output_dataset = None
+
+# Write the time and counters per stage to this JSON file (e.g. 'export_metrics_hafsql.json') and in the Prometheus text format
+metrics_file = None
+prometheus_file = None
+
+# Keep the fetched operations in this directory (e.g. 'operations_hafsql') so ranges fetched before are read
+# from disk. Needs pyarrow, incremental runs don't use it.
+operation_store_dir = None
+operation_store = OperationStore(operation_store_dir) if operation_store_dir else None
+
 # Database connection parameters
 db_params = {
     'host': 'hafsql-sql.mahdiyari.info',
@@ -17,249 +86,618 @@ db_params = {
     'user': 'hafsql_public',
     'password': 'hafsql_public'
 }
+# Connections are shared by all export threads and chunk workers and reused between queries
+db_max_connections = 8
+database = DatabasePool(db_params, db_max_connections)
+# Separate connections for the ratio and operation id lookups, which can happen while a query holds its connection
+ratio_database = DatabasePool(db_params, 2)
+
+def configure(**settings):
+    # Sets parameters of this module, e.g. from a config file, and rebuilds the objects made from them
+    global operation_store, database, ratio_database, ratio_cache
+    for name, value in settings.items():
+        if name not in globals():
+            raise ValueError(f"Unknown parameter {name}")
+        globals()[name] = value
+    operation_store = OperationStore(operation_store_dir) if operation_store_dir else None
+    database = DatabasePool(db_params, db_max_connections)
+    ratio_database = DatabasePool(db_params, 2)
+    ratio_cache = None
+
+# Queries that fail over the whole range are split into time chunks, which are bisected when they fail
+# until they are shorter than min_chunk_interval. Chunks run concurrently on chunk_workers connections
+# and chunks up to account_filter_interval only filter by time and pick the accounts client side.
+# An operation type is given up once a chunk of min_chunk_interval fails or after max_chunk_retries splits.
+min_chunk_interval = timedelta(hours=1)
+max_chunk_retries = 24
+account_filter_interval = timedelta(days=1)
+chunk_workers = 4
+# Chunk interval per operation type is adjusted so chunks take about this many seconds
+target_chunk_seconds = 30
+chunk_intervals = {}
+
+# Queries to fetch transactions for each operation type. Each row starts with the account it belongs to,
+# or NULL if it can belong to either sender or recipient, in which case the direction is set per account,
+# and ends with the operation id. fill_order gives each side a leg to and one from hive.market like the account
+# history, an order filled against one of the account's own orders only counts once.
+queries = [
+    """
+    SELECT NULL AS account, hafsql.get_timestamp(id), 'transfer' AS type, 
+           NULL AS direction, 
+           "from_account" AS sender, "to_account" AS recipient, symbol AS currency, amount AS total_amount, id
+    FROM operation_transfer_table
+    WHERE ("from_account" = ANY(%(accounts)s) OR "to_account" = ANY(%(accounts)s)) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    """
+    SELECT owner AS account, hafsql.get_timestamp(id), 'interest' AS type, 
+           'incoming' AS direction, 
+           'hive.rewards' AS sender, owner AS recipient, interest_symbol AS currency, interest AS total_amount, id
+    FROM operation_interest_table
+    WHERE owner = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    """
+    SELECT to_account AS account, hafsql.get_timestamp(id), 'fill_vesting_withdraw' AS type, 
+           'unstake' AS direction, 
+           CASE 
+               WHEN to_account = from_account THEN 'staked.hive'
+               ELSE from_account
+           END AS sender,
+           to_account AS recipient, 'HIVE' AS currency, deposited AS total_amount, id
+    FROM operation_fill_vesting_withdraw_table
+    WHERE to_account = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    """
+    SELECT curator AS account, hafsql.get_timestamp(id), 'curation_reward' AS type, 
+           'incoming' AS direction, 
+           'hive.rewards' AS sender, curator AS recipient, 'HP' AS currency, hafsql.vests_to_hive(reward,hafd.operation_id_to_block_num(id)) AS total_amount, id
+    FROM operation_curation_reward_table
+    WHERE curator = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    """
+    SELECT owner AS account, hafsql.get_timestamp(id), 'fill_convert_request' AS type, 
+           'incoming' AS direction, 
+           owner AS sender, owner AS recipient, 'HIVE' AS currency, amount_out AS total_amount, id
+    FROM operation_fill_convert_request_table
+    WHERE owner = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    """
+    SELECT owner AS account, hafsql.get_timestamp(id), 'convert' AS type, 
+           'outgoing' AS direction, 
+           owner AS sender, owner AS recipient, 'HBD' AS currency, amount AS total_amount, id
+    FROM operation_convert_table
+    WHERE owner = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    """
+    SELECT benefactor AS account, hafsql.get_timestamp(id), 'comment_benefactor_reward' AS type, 
+           'incoming' AS direction, 
+           'hive.rewards' AS sender, benefactor AS recipient, 'HBD' AS currency, hbd_payout AS total_amount, id
+    FROM operation_comment_benefactor_reward_table
+    WHERE benefactor = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    UNION ALL
+    SELECT benefactor AS account, hafsql.get_timestamp(id), 'comment_benefactor_reward' AS type, 
+           'incoming' AS direction, 
+           'hive.rewards' AS sender, benefactor AS recipient, 'HIVE' AS currency, hive_payout AS total_amount, id
+    FROM operation_comment_benefactor_reward_table
+    WHERE benefactor = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    UNION ALL
+    SELECT benefactor AS account, hafsql.get_timestamp(id), 'comment_benefactor_reward' AS type, 
+           'incoming' AS direction, 
+           'hive.rewards' AS sender, benefactor AS recipient, 'HP' AS currency, hafsql.vests_to_hive(vesting_payout,hafd.operation_id_to_block_num(id)) AS total_amount, id
+    FROM operation_comment_benefactor_reward_table
+    WHERE benefactor = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    """
+    SELECT author AS account, hafsql.get_timestamp(id), 'author_reward' AS type, 
+           'incoming' AS direction, 
+           'hive.rewards' AS sender, author AS recipient, 'HBD' AS currency, hbd_payout AS total_amount, id
+    FROM operation_author_reward_table
+    WHERE author = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    UNION ALL
+    SELECT author AS account, hafsql.get_timestamp(id), 'author_reward' AS type, 
+           'incoming' AS direction, 
+           'hive.rewards' AS sender, author AS recipient, 'HIVE' AS currency, hive_payout AS total_amount, id
+    FROM operation_author_reward_table
+    WHERE author = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    UNION ALL
+    SELECT author AS account, hafsql.get_timestamp(id), 'author_reward' AS type, 
+           'incoming' AS direction, 
+           'hive.rewards' AS sender, author AS recipient, 'HP' AS currency, hafsql.vests_to_hive(vesting_payout,hafd.operation_id_to_block_num(id)) AS total_amount, id
+    FROM operation_author_reward_table
+    WHERE author = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    """
+    SELECT current_owner AS account, hafsql.get_timestamp(id), 'fill_order' AS type, 
+           'outgoing' AS direction, 
+           current_owner AS sender, 'hive.market' AS recipient, current_pays_symbol AS currency, current_pays AS total_amount, id
+    FROM operation_fill_order_table
+    WHERE current_owner = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    UNION ALL
+    SELECT current_owner AS account, hafsql.get_timestamp(id), 'fill_order' AS type, 
+           'incoming' AS direction, 
+           'hive.market' AS sender, current_owner AS recipient, open_pays_symbol AS currency, open_pays AS total_amount, id
+    FROM operation_fill_order_table
+    WHERE current_owner = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    UNION ALL
+    SELECT open_owner AS account, hafsql.get_timestamp(id), 'fill_order' AS type, 
+           'incoming' AS direction, 
+           'hive.market' AS sender, open_owner AS recipient, current_pays_symbol AS currency,
+           CASE WHEN open_owner <> current_owner THEN current_pays ELSE 0 END AS total_amount, id
+    FROM operation_fill_order_table
+    WHERE open_owner = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    UNION ALL
+    SELECT open_owner AS account, hafsql.get_timestamp(id), 'fill_order' AS type, 
+           'outgoing' AS direction, 
+           open_owner AS sender, 'hive.market' AS recipient, open_pays_symbol AS currency,
+           CASE WHEN open_owner <> current_owner THEN open_pays ELSE 0 END AS total_amount, id
+    FROM operation_fill_order_table
+    WHERE open_owner = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    """
+    SELECT receiver AS account, hafsql.get_timestamp(id), 'proposal_pay' AS type, 
+           'incoming' AS direction, 
+           payer AS sender, receiver AS recipient, 'HBD' AS currency, payment AS total_amount, id
+    FROM operation_proposal_pay_table
+    WHERE receiver = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    """
+    SELECT "from_account" AS account, hafsql.get_timestamp(id), 'transfer_to_vesting' AS type, 
+           'outgoing' AS direction, 
+           "from_account" AS sender, 'staked.hive' AS recipient, 'HIVE' AS currency, amount AS total_amount, id
+    FROM operation_transfer_to_vesting_table
+    WHERE "from_account" = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    """
+    SELECT NULL AS account, hafsql.get_timestamp(id), 'delegate_vesting_shares' AS type, 
+           NULL AS direction, 
+           delegator AS sender, delegatee AS recipient, 'HP' AS currency, hafsql.vests_to_hive(vesting_shares,hafd.operation_id_to_block_num(id)) AS total_amount, id
+    FROM operation_delegate_vesting_shares_table
+    WHERE (delegator = ANY(%(accounts)s) OR delegatee = ANY(%(accounts)s)) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    """
+    SELECT account AS account, hafsql.get_timestamp(id), 'return_vesting_delegation' AS type, 
+           'undelegate' AS direction, 
+           'delegated.hive' AS sender, account AS recipient, 'HP' AS currency, hafsql.vests_to_hive(vesting_shares,hafd.operation_id_to_block_num(id)) AS total_amount, id
+    FROM operation_return_vesting_delegation_table
+    WHERE account = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    """
+    SELECT producer AS account, hafsql.get_timestamp(id), 'producer_reward' AS type, 
+           'incoming' AS direction, 
+           'hive.rewards' AS sender, producer AS recipient, 'HP' AS currency, hafsql.vests_to_hive(vesting_shares,hafd.operation_id_to_block_num(id)) AS total_amount, id
+    FROM operation_producer_reward_table
+    WHERE producer = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """
+]
+
+# Queries of the operation types with VESTS amounts for client_vests_conversion. Rows have the HBD, HIVE and
+# VESTS amounts in place of the currency and amount, followed by the block number and the operation id.
+vests_queries = {
+    'curation_reward': """
+    SELECT curator AS account, hafsql.get_timestamp(id), 'curation_reward' AS type, 
+           'incoming' AS direction, 
+           'hive.rewards' AS sender, curator AS recipient, NULL AS hbd_amount, NULL AS hive_amount, reward AS vests_amount, hafd.operation_id_to_block_num(id) AS block_num, id
+    FROM operation_curation_reward_table
+    WHERE curator = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    'comment_benefactor_reward': """
+    SELECT benefactor AS account, hafsql.get_timestamp(id), 'comment_benefactor_reward' AS type, 
+           'incoming' AS direction, 
+           'hive.rewards' AS sender, benefactor AS recipient, hbd_payout AS hbd_amount, hive_payout AS hive_amount, vesting_payout AS vests_amount, hafd.operation_id_to_block_num(id) AS block_num, id
+    FROM operation_comment_benefactor_reward_table
+    WHERE benefactor = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    'author_reward': """
+    SELECT author AS account, hafsql.get_timestamp(id), 'author_reward' AS type, 
+           'incoming' AS direction, 
+           'hive.rewards' AS sender, author AS recipient, hbd_payout AS hbd_amount, hive_payout AS hive_amount, vesting_payout AS vests_amount, hafd.operation_id_to_block_num(id) AS block_num, id
+    FROM operation_author_reward_table
+    WHERE author = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    'delegate_vesting_shares': """
+    SELECT NULL AS account, hafsql.get_timestamp(id), 'delegate_vesting_shares' AS type, 
+           NULL AS direction, 
+           delegator AS sender, delegatee AS recipient, NULL AS hbd_amount, NULL AS hive_amount, vesting_shares AS vests_amount, hafd.operation_id_to_block_num(id) AS block_num, id
+    FROM operation_delegate_vesting_shares_table
+    WHERE (delegator = ANY(%(accounts)s) OR delegatee = ANY(%(accounts)s)) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    'return_vesting_delegation': """
+    SELECT account AS account, hafsql.get_timestamp(id), 'return_vesting_delegation' AS type, 
+           'undelegate' AS direction, 
+           'delegated.hive' AS sender, account AS recipient, NULL AS hbd_amount, NULL AS hive_amount, vesting_shares AS vests_amount, hafd.operation_id_to_block_num(id) AS block_num, id
+    FROM operation_return_vesting_delegation_table
+    WHERE account = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+    'producer_reward': """
+    SELECT producer AS account, hafsql.get_timestamp(id), 'producer_reward' AS type, 
+           'incoming' AS direction, 
+           'hive.rewards' AS sender, producer AS recipient, NULL AS hbd_amount, NULL AS hive_amount, vesting_shares AS vests_amount, hafd.operation_id_to_block_num(id) AS block_num, id
+    FROM operation_producer_reward_table
+    WHERE producer = ANY(%(accounts)s) AND id BETWEEN %(start_id)s AND %(end_id)s
+    """,
+}
+
+# hafsql.vests_to_hive is called once per block on this many VESTS, which keeps the precision of the ratio
+ratio_probe_vests = 10**9
+
+@timer('ratio_lookup')
+def get_vests_to_hive_ratios(block_nums):
+    # Ratios of several blocks with one query, blocks missing from the result are left out
+    import psycopg2
+    count('ratio_lookup', 'blocks', len(block_nums))
+    try:
+        with ratio_database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT block_num, hafsql.vests_to_hive(%(vests)s, block_num) FROM unnest(%(blocks)s::integer[]) AS block_num",
+                           {'vests': ratio_probe_vests, 'blocks': list(block_nums)})
+            return {b: float(hive) / ratio_probe_vests for b, hive in cursor.fetchall() if hive is not None}
+    except psycopg2.Error:
+        return {}
+
+def get_vests_to_hive_ratio(block_num):
+    ratios = get_vests_to_hive_ratios([block_num])
+    if block_num not in ratios:
+        raise RuntimeError(f"No VESTS to HIVE ratio for block {block_num}")
+    return ratios[block_num]
+
+ratio_cache = None
+ratio_cache_lock = threading.Lock()
+
+def get_ratio_cache():
+    # Opened on first use, so the cache file is only created when converting client side
+    global ratio_cache
+    with ratio_cache_lock:
+        if ratio_cache is None:
+            ratio_cache = VestsToHiveRatioCache(get_vests_to_hive_ratios, get_vests_to_hive_ratio, ratio_cache_file, ratio_batch_size, ratio_sample_stride, ratio_interpolation_tolerance)
+        return ratio_cache
+
+def convert_vests(rows):
+    # Conversion stage of the vests_queries. The ratios of each batch are looked up once per distinct block,
+    # the VESTS amounts of the batch are converted at once and every row is unpivoted into HBD, HIVE and HP
+    # rows of the usual shape.
+    ratio_cache = get_ratio_cache()
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, vests_batch_size))
+        if not batch:
+            return
+        count('convert_vests', 'rows', len(batch))
+        ratio_cache.prefetch({row[-2] for row in batch if row[-3]})
+        vests = np.array([float(row[-3] or 0) for row in batch])
+        ratios = np.array([ratio_cache.get(row[-2]) if row[-3] else 0 for row in batch])
+        hp = np.round(vests * ratios, 3)
+        for row, amount in zip(batch, hp.tolist()):
+            hbd, hive = row[6], row[7]
+            if hbd:
+                yield row[:6] + ('HBD', hbd, row[-1])
+            if hive:
+                yield row[:6] + ('HIVE', hive, row[-1])
+            if amount:
+                yield row[:6] + ('HP', amount, row[-1])
+
+@timer('id_lookup')
+def get_operation_ids(timestamps):
+    # Operation ids of several timestamps with one query, in the same order
+    count('id_lookup', 'timestamps', len(timestamps))
+    with ratio_database.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT hafsql.id_from_timestamp(t) FROM unnest(%(timestamps)s::timestamp[]) WITH ORDINALITY AS u(t, n) ORDER BY n",
+                       {'timestamps': list(timestamps)})
+        return [row[0] for row in cursor.fetchall()]
+
+# Ids of the range bounds, chunk bounds and midnights, resolved once per run
+id_planner = OperationIdPlanner(get_operation_ids)
+
+def plan_ids(params, start_date, end_date):
+    # Query parameters of a range with its id bounds, and the ids of its days when dating rows by id.
+    # Bounds and days are looked up together the first time.
+    if day_buckets:
+        id_planner.resolve(id_planner.edges(start_date, end_date) + id_planner.day_edges(start_date, end_date))
+    start_id, end_id = id_planner.bounds(start_date, end_date)
+    params = dict(params, start=start_date, end=end_date, start_id=start_id, end_id=end_id)
+    if day_buckets:
+        params['day_ids'] = id_planner.days(start_date, end_date)[1].tolist()
+    return params
+
+def date_by_id(rows, start_date, end_date):
+    # Replaces the timestamp of the rows by the day their operation id falls in, batch by batch
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, day_batch_size))
+        if not batch:
+            return
+        for row, day in zip(batch, id_planner.bucket([row[-1] for row in batch], start_date, end_date)):
+            yield (row[0], day) + row[2:]
+
+def demultiplex(row, account_names, after_ids=None, with_ids=False):
+    # Yields the row as (date, type, direction, sender, recipient, currency, amount), followed by the operation id if
+    # with_ids is set, for every requested account it belongs to, skipping accounts that already exported the operation
+    account, tx_date, tx_type, direction, sender, recipient, currency, amount, op_id = row
+    tail = (amount, op_id) if with_ids else (amount,)
+    if account is not None:
+        if account in account_names and (not after_ids or op_id > after_ids.get(account, 0)):
+            yield account, (tx_date, tx_type, direction, sender, recipient, currency) + tail
+        return
+    for account in {sender, recipient}:
+        if account in account_names and (not after_ids or op_id > after_ids.get(account, 0)):
+            direction = 'incoming' if recipient == account else 'outgoing'
+            yield account, (tx_date, tx_type, direction, sender, recipient, currency) + tail
+
+def new_transactions():
+    # Holds the transactions of one account, either in typed columns or only their sums when streaming
+    return TransactionAggregator() if streaming else TransactionColumns(by_day=server_aggregation)
+
+def dated_by_id_query(query):
+    # Leaves out hafsql.get_timestamp, the rows are dated by date_by_id
+    return query.replace('hafsql.get_timestamp(id)', 'NULL::timestamp AS get_timestamp')
 
-# Intervals to check when transactions need to be split up
-intervals = [[timedelta(days=366),'yearly'],
-             [timedelta(days=183),'half-yearly'],
-             [timedelta(days=31),'monthly'],
-             [timedelta(days=7),'weekly'],
-             [timedelta(days=1),'daily'], 
-             [timedelta(hours=6),'6-hour'], 
-             [timedelta(hours=1),'hourly']]
-
-def execute_query(conn, cursor, query, params, tx_type, account_name, filter_account=False):
-    results = []
+def aggregated_query(query):
+    # Wraps a query to return the sum per account, day and group, with the last operation id of the group.
+    # get_timestamp is the name Postgres gives the unnamed hafsql.get_timestamp(id) column. With day_buckets
+    # the days are the id ranges between the midnights, and are dated client side by the last id of the group.
+    day = "date_trunc('day', get_timestamp)"
+    if day_buckets:
+        day = "width_bucket(id, %(day_ids)s::bigint[])"
+    return f"""
+    SELECT account, {day} AS date, type, direction, sender, recipient, currency, SUM(total_amount) AS total_amount, MAX(id) AS id
+    FROM ({query}) AS transactions
+    WHERE total_amount > 0
+    GROUP BY account, {day}, type, direction, sender, recipient, currency
+    """
+
+def execute_query(conn, cursor, query, params, tx_type, account_names, after_ids=None, with_ids=False):
+    # psycopg2 is loaded with the first connection
+    import psycopg2
+    results = {a: [] if with_ids else new_transactions() for a in account_names}
+    if day_buckets:
+        query = dated_by_id_query(query)
+    if server_aggregation and not after_ids and not with_ids:
+        query = aggregated_query(query)
+    fetched = 0
     try:
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        for row in rows:
-            tx_date, tx_type, direction, sender, recipient, currency, amount = row
-            if amount > 0 and (not filter_account or account_name in (sender, recipient)):
-                results.append((tx_date, tx_type, direction, sender, recipient, currency, amount))
+        with timed('execute_query', tx_type):
+            if streaming:
+                # Named cursors are declared on the server and fetched itersize rows at a time
+                cursor = conn.cursor(name='transactions_stream')
+                cursor.itersize = stream_itersize
+                cursor.execute(query, params)
+                rows = cursor
+            else:
+                cursor.execute(query, params)
+                rows = cursor.fetchall()
+            if 'AS vests_amount' in query:
+                rows = convert_vests(rows)
+            if day_buckets:
+                rows = date_by_id(rows, params['start'], params['end'])
+            for row in rows:
+                fetched += 1
+                if row[-2] > 0:
+                    for account, transaction in demultiplex(row, results, after_ids, with_ids):
+                        results[account].append(transaction)
+            if streaming:
+                cursor.close()
+        count('execute_query', 'rows', fetched, tx_type)
         return results, True
-    except (OperationalError, psycopg2.Error) as e:
+    except psycopg2.Error as e:
         #print(f"\n{e}", end="")
-        return [], False
-
-def execute_query_with_intervals(conn, cursor, query, params, tx_type, account_name, start_date, end_date, interval):
-    cursor.close()
-    conn.close()
-    conn = psycopg2.connect(**db_params)
-    cursor = conn.cursor()
-    results = []
+        count('execute_query', 'failures', 1, tx_type)
+        return {}, False
+
+def time_filtered_query(query):
+    # Only filter by time, the rows of the requested accounts are picked client side
+    q_parts = query.split("UNION ALL")
+    q = []
+    for part in q_parts:
+        q.append(part.split(" WHERE ")[0] + " WHERE id BETWEEN %(start_id)s AND %(end_id)s")
+    return " UNION ALL ".join(q)
+
+def split_interval(start_date, end_date, interval):
+    # Splits the range into consecutive (start, end) chunks of at most interval, both ends included
+    chunks = []
     current_start = start_date
-    filter_account = interval <= timedelta(days=1)
     while current_start < end_date:
         current_end = min(current_start + interval, end_date)
-        if filter_account:
-            q_parts = query.split("UNION ALL")
-            q = []
-            for part in q_parts:
-                q.append(part.split(" WHERE ")[0] + " WHERE id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)")
-            query = " UNION ALL ".join(q)
-            if len(params) == 5:
-                params = (account_name, current_start, current_end)
-            else:
-                params = (current_start, current_end) * len(q_parts)
-        else:
-            params = params[:-2] + (current_start, current_end)
-        result, success = execute_query(conn, cursor, query, params, tx_type, account_name, filter_account)
-        if not success:
-            return [], False, conn, cursor
-        results.extend(result)
+        chunks.append((current_start, current_end))
         current_start = current_end + timedelta(seconds=1)
-    return results, True, conn, cursor
+    return chunks
 
-def get_transactions_for_account(account_name, start_date, end_date):
-    print('Fetching transactions for account ' + account_name + '...')
-
-    # Connect to the hafsql database
-    conn = psycopg2.connect(**db_params)
-    cursor = conn.cursor()
-
-    # List to hold transaction data
-    transactions = []
-
-    # Queries to fetch transactions for each operation type
-    queries = [
-        ("""
-        SELECT hafsql.get_timestamp(id), 'transfer' AS type, 
-               CASE 
-                   WHEN "to_account" = %s THEN 'incoming' 
-                   ELSE 'outgoing' 
-               END AS direction, 
-               "from_account" AS sender, "to_account" AS recipient, symbol AS currency, amount AS total_amount
-        FROM operation_transfer_table
-        WHERE ("from_account" = %s OR "to_account" = %s) AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        """, (account_name, account_name, account_name, start_date, end_date)),
-        ("""
-        SELECT hafsql.get_timestamp(id), 'interest' AS type, 
-               'incoming' AS direction, 
-               'hive.rewards' AS sender, owner AS recipient, interest_symbol AS currency, interest AS total_amount
-        FROM operation_interest_table
-        WHERE owner = %s AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        """, (account_name, start_date, end_date)),
-        ("""
-        SELECT hafsql.get_timestamp(id), 'fill_vesting_withdraw' AS type, 
-               'unstake' AS direction, 
-               CASE 
-                   WHEN to_account = from_account THEN 'staked.hive'
-                   ELSE from_account
-               END AS sender,
-               to_account AS recipient, 'HIVE' AS currency, deposited AS total_amount
-        FROM operation_fill_vesting_withdraw_table
-        WHERE to_account = %s AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        """, (account_name, start_date, end_date)),
-        ("""
-        SELECT hafsql.get_timestamp(id), 'curation_reward' AS type, 
-               'incoming' AS direction, 
-               'hive.rewards' AS sender, curator AS recipient, 'HP' AS currency, hafsql.vests_to_hive(reward,hafd.operation_id_to_block_num(id)) AS total_amount
-        FROM operation_curation_reward_table
-        WHERE curator = %s AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        """, (account_name, start_date, end_date)),
-        ("""
-        SELECT hafsql.get_timestamp(id), 'fill_convert_request' AS type, 
-               'incoming' AS direction, 
-               owner AS sender, owner AS recipient, 'HIVE' AS currency, amount_out AS total_amount
-        FROM operation_fill_convert_request_table
-        WHERE owner = %s AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        """, (account_name, start_date, end_date)),
-        ("""
-        SELECT hafsql.get_timestamp(id), 'convert' AS type, 
-               'outgoing' AS direction, 
-               owner AS sender, owner AS recipient, 'HBD' AS currency, amount AS total_amount
-        FROM operation_convert_table
-        WHERE owner = %s AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        """, (account_name, start_date, end_date)),
-        ("""
-        SELECT hafsql.get_timestamp(id), 'comment_benefactor_reward' AS type, 
-               'incoming' AS direction, 
-               'hive.rewards' AS sender, benefactor AS recipient, 'HBD' AS currency, hbd_payout AS total_amount
-        FROM operation_comment_benefactor_reward_table
-        WHERE benefactor = %s AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        UNION ALL
-        SELECT hafsql.get_timestamp(id), 'comment_benefactor_reward' AS type, 
-               'incoming' AS direction, 
-               'hive.rewards' AS sender, benefactor AS recipient, 'HIVE' AS currency, hive_payout AS total_amount
-        FROM operation_comment_benefactor_reward_table
-        WHERE benefactor = %s AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        UNION ALL
-        SELECT hafsql.get_timestamp(id), 'comment_benefactor_reward' AS type, 
-               'incoming' AS direction, 
-               'hive.rewards' AS sender, benefactor AS recipient, 'HP' AS currency, hafsql.vests_to_hive(vesting_payout,hafd.operation_id_to_block_num(id)) AS total_amount
-        FROM operation_comment_benefactor_reward_table
-        WHERE benefactor = %s AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        """, (account_name, start_date, end_date, account_name, start_date, end_date, account_name, start_date, end_date)),
-        ("""
-        SELECT hafsql.get_timestamp(id), 'author_reward' AS type, 
-               'incoming' AS direction, 
-               'hive.rewards' AS sender, author AS recipient, 'HBD' AS currency, hbd_payout AS total_amount
-        FROM operation_author_reward_table
-        WHERE author = %s AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        UNION ALL
-        SELECT hafsql.get_timestamp(id), 'author_reward' AS type, 
-               'incoming' AS direction, 
-               'hive.rewards' AS sender, author AS recipient, 'HIVE' AS currency, hive_payout AS total_amount
-        FROM operation_author_reward_table
-        WHERE author = %s AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        UNION ALL
-        SELECT hafsql.get_timestamp(id), 'author_reward' AS type, 
-               'incoming' AS direction, 
-               'hive.rewards' AS sender, author AS recipient, 'HP' AS currency, hafsql.vests_to_hive(vesting_payout,hafd.operation_id_to_block_num(id)) AS total_amount
-        FROM operation_author_reward_table
-        WHERE author = %s AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        """, (account_name, start_date, end_date, account_name, start_date, end_date, account_name, start_date, end_date)),
-        ("""
-        SELECT hafsql.get_timestamp(id), 'fill_order' AS type, 
-               CASE 
-                   WHEN open_owner = %s THEN 'incoming' 
-                   ELSE 'outgoing' 
-               END AS direction, 
-               current_owner AS sender, open_owner AS recipient, current_pays_symbol AS currency, current_pays AS total_amount
-        FROM operation_fill_order_table
-        WHERE (current_owner = %s OR open_owner = %s) AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        """, (account_name, account_name, account_name, start_date, end_date)),
-        ("""
-        SELECT hafsql.get_timestamp(id), 'proposal_pay' AS type, 
-               'incoming' AS direction, 
-               payer AS sender, receiver AS recipient, 'HBD' AS currency, payment AS total_amount
-        FROM operation_proposal_pay_table
-        WHERE receiver = %s AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        """, (account_name, start_date, end_date)),
-        ("""
-        SELECT hafsql.get_timestamp(id), 'transfer_to_vesting' AS type, 
-               'outgoing' AS direction, 
-               "from_account" AS sender, 'staked.hive' AS recipient, 'HIVE' AS currency, amount AS total_amount
-        FROM operation_transfer_to_vesting_table
-        WHERE "from_account" = %s AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        """, (account_name, start_date, end_date)),
-        ("""
-        SELECT hafsql.get_timestamp(id), 'delegate_vesting_shares' AS type, 
-               CASE 
-                   WHEN delegatee = %s THEN 'incoming' 
-                   ELSE 'outgoing' 
-               END AS direction, 
-               delegator AS sender, delegatee AS recipient, 'HP' AS currency, hafsql.vests_to_hive(vesting_shares,hafd.operation_id_to_block_num(id)) AS total_amount
-        FROM operation_delegate_vesting_shares_table
-        WHERE (delegator = %s OR delegatee = %s) AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        """, (account_name, account_name, account_name, start_date, end_date)),
-        ("""
-        SELECT hafsql.get_timestamp(id), 'return_vesting_delegation' AS type, 
-               'undelegate' AS direction, 
-               'delegated.hive' AS sender, account AS recipient, 'HP' AS currency, hafsql.vests_to_hive(vesting_shares,hafd.operation_id_to_block_num(id)) AS total_amount
-        FROM operation_return_vesting_delegation_table
-        WHERE account = %s AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        """, (account_name, start_date, end_date)),
-        ("""
-        SELECT hafsql.get_timestamp(id), 'producer_reward' AS type, 
-               'incoming' AS direction, 
-               'hive.rewards' AS sender, producer AS recipient, 'HP' AS currency, hafsql.vests_to_hive(vesting_shares,hafd.operation_id_to_block_num(id)) AS total_amount
-        FROM operation_producer_reward_table
-        WHERE producer = %s AND id BETWEEN hafsql.id_from_timestamp(%s) AND hafsql.id_from_timestamp(%s)
-        """, (account_name, start_date, end_date))
-    ]
-
-    for query, params in queries:
-        tx_type = query.split(',')[1].split("AS")[0].strip()
-        result, success = execute_query(conn, cursor, query, params, tx_type, account_name)
+def learn_chunk_interval(tx_type, interval, elapsed=None):
+    # Adjusts the chunk interval of an operation type to the latency seen, or halves it after a failure
+    if elapsed is None:
+        learned = interval / 2
+        if tx_type in chunk_intervals:
+            learned = min(learned, chunk_intervals[tx_type])
+    else:
+        learned = min(interval * target_chunk_seconds / max(elapsed, 0.001), interval * 2)
+    chunk_intervals[tx_type] = max(timedelta(seconds=int(learned.total_seconds())), min_chunk_interval)
+
+def execute_chunk(query, params, tx_type, account_names, start_date, end_date, after_ids, with_ids):
+    if end_date - start_date <= account_filter_interval:
+        query = time_filtered_query(query)
+    params = plan_ids(params, start_date, end_date)
+    with database.connection() as conn:
+        started = time.monotonic()
+        result, success = execute_query(conn, conn.cursor(), query, params, tx_type, account_names, after_ids, with_ids)
+        return result, success, time.monotonic() - started
+
+def execute_query_with_intervals(query, params, tx_type, account_names, start_date, end_date, after_ids=None, with_ids=False):
+    # Runs a query that is too heavy for the whole range in time chunks on chunk_workers connections.
+    # Chunks that fail are bisected and retried while completed chunks are kept. The halves of a failed chunk
+    # are queued first, so a database that rejects everything is found out after a few splits of one chunk
+    # instead of splitting all of them.
+    interval = chunk_intervals.get(tx_type, timedelta(seconds=(end_date - start_date).total_seconds() // 2))
+    chunks = deque(split_interval(start_date, end_date, interval))
+    # The ids of all chunk bounds with one lookup, bisected chunks only look up the second after their middle
+    id_planner.resolve([t for chunk in chunks for t in id_planner.edges(*chunk)])
+    results = {}
+    retries = 0
+    with timed('execute_query_with_intervals', tx_type), ThreadPoolExecutor(chunk_workers) as executor:
+        futures = {}
+        while chunks or futures:
+            while chunks and len(futures) < chunk_workers:
+                chunk_start, chunk_end = chunks.popleft()
+                future = executor.submit(execute_chunk, query, params, tx_type, account_names, chunk_start, chunk_end, after_ids, with_ids)
+                futures[future] = (chunk_start, chunk_end)
+                count('execute_query_with_intervals', 'chunks', 1, tx_type)
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk_start, chunk_end = futures.pop(future)
+                result, success, elapsed = future.result()
+                if success:
+                    results[chunk_start] = result
+                    learn_chunk_interval(tx_type, chunk_end - chunk_start, elapsed)
+                elif chunk_end - chunk_start > min_chunk_interval and retries < max_chunk_retries:
+                    retries += 1
+                    learn_chunk_interval(tx_type, chunk_end - chunk_start)
+                    middle = chunk_start + timedelta(seconds=(chunk_end - chunk_start).total_seconds() // 2)
+                    print(f"\nFailed getting {tx_type} transactions from {chunk_start} to {chunk_end}. Splitting...", end="")
+                    count('execute_query_with_intervals', 'retries', 1, tx_type)
+                    chunks.appendleft((middle + timedelta(seconds=1), chunk_end))
+                    chunks.appendleft((chunk_start, middle))
+                else:
+                    # The chunks still running are waited for when the executor shuts down
+                    return {}, False
+
+    merged = {a: [] if with_ids else new_transactions() for a in account_names}
+    for chunk_start in sorted(results):
+        for account, transactions in results[chunk_start].items():
+            merged[account].extend(transactions)
+    return merged, True
+
+def fetch_query(query, tx_type, account_names, start_date, end_date, after_ids=None, with_ids=False):
+    accounts = ', '.join(account_names)
+    params = plan_ids({'accounts': list(account_names)}, start_date, end_date)
+    # Skip the whole range if this operation type already needed smaller chunks
+    success = False
+    if chunk_intervals.get(tx_type, end_date - start_date) >= end_date - start_date:
+        with database.connection() as conn:
+            result, success = execute_query(conn, conn.cursor(), query, params, tx_type, account_names, after_ids, with_ids)
+        if not success:
+            print(f"\n{accounts}: failed getting {tx_type} transactions. Splitting into chunks...", end="")
+    if not success:
+        result, success = execute_query_with_intervals(query, params, tx_type, account_names, start_date, end_date, after_ids, with_ids)
         if not success:
-            for interval, interval_name in intervals:
-                if interval < end_date - start_date:
-                    print(f"\nFailed getting {tx_type} transactions. Trying {interval_name} intervals...", end="")
-                    result, success, conn, cursor = execute_query_with_intervals(conn, cursor, query, params, tx_type, account_name, start_date, end_date, interval)
-                    if success:
-                        break
-            if not success:
-                print(f"\nFailed getting {tx_type} transactions even with these low intervals. Giving up.")
-                sys.exit(1)
-        transactions.extend(result)
-        print(f"\n{tx_type} transactions collected: {len(result)}", end="")
-
-    cursor.close()
-    conn.close()
+            raise RuntimeError(f"Failed getting {tx_type} transactions for {accounts} even with {min_chunk_interval} chunks or {max_chunk_retries} splits. Giving up.")
+    return result
+
+def fetch_query_with_store(query, tx_type, account_names, start_date, end_date):
+    # Only fetches the ranges missing from the operation store, then reads all accounts from it
+    missing = {a: operation_store.missing(a, [tx_type], start_date, end_date) for a in account_names}
+    for range_start, range_end in merge_ranges(r for ranges in missing.values() for r in ranges):
+        result = fetch_query(query, tx_type, account_names, range_start, range_end, with_ids=True)
+        for account, rows in result.items():
+            rows = pd.DataFrame(rows, columns=columns + ['id'])
+            rows['timestamp'] = rows['date']
+            # Accounts that already had part of the range only store what they were missing
+            for start, end in missing[account]:
+                start, end = max(start, range_start), min(end, range_end)
+                if start <= end:
+                    operation_store.write(account, tx_type, rows[(rows['timestamp'] >= start) & (rows['timestamp'] <= end)], start, end)
+
+    results = {}
+    for account in account_names:
+        results[account] = new_transactions()
+        rows = operation_store.read(account, [tx_type], start_date, end_date)
+        results[account].extend(rows[columns].itertuples(index=False, name=None))
+    return results
+
+def query_type(query):
+    # Operation type of one of the queries
+    return query.split(',')[2].split("AS")[0].strip().strip("'")
+
+def queries_by_type():
+    # Query to run per operation type, the vests_queries when converting VESTS client side
+    by_type = {query_type(query): query for query in queries}
+    if client_vests_conversion and not server_aggregation:
+        by_type.update(vests_queries)
+    return by_type
+
+def get_transactions_for_accounts(account_names, start_date, end_date, after_ids=None):
+    # Fetches the transactions of several accounts with one query per operation type. after_ids maps accounts
+    # to the last operation id they already exported, older operations are skipped.
+    accounts = ', '.join(account_names)
+    print('Fetching transactions for accounts ' + accounts + '...')
+
+    # Lists to hold transaction data per account
+    transactions = {a: new_transactions() for a in account_names}
+
+    for tx_type, query in queries_by_type().items():
+        if operation_store is None or after_ids is not None:
+            result = fetch_query(query, tx_type, account_names, start_date, end_date, after_ids)
+        else:
+            result = fetch_query_with_store(query, tx_type, account_names, start_date, end_date)
+        for account, rows in result.items():
+            transactions[account].extend(rows)
+            print(f"\n{account}: {tx_type} transactions collected: {len(rows)}", end="")
 
     return transactions
 
+def get_transactions_for_account(account_name, start_date, end_date):
+    return get_transactions_for_accounts([account_name], start_date, end_date)[account_name]
+
 def aggregate_transactions(transactions):
-    df = pd.DataFrame(transactions, columns=['date', 'type', 'direction', 'sender', 'recipient', 'currency', 'amount'])
+    if isinstance(transactions, (TransactionAggregator, TransactionColumns)):
+        return transactions.to_dataframe()
+    df = pd.DataFrame(transactions, columns=columns)
     df = df.groupby(['date', 'type', 'direction', 'sender', 'recipient', 'currency']).sum().reset_index()
     return df
 
-end_date = end_date + timedelta(days=1) - timedelta(seconds=1)
-for a in account_names:
-    # Get transactions for the given account and time range
-    transactions = get_transactions_for_account(a, start_date, end_date)
+# New high-water marks of incremental exports, saved once their CSV is written
+high_water_marks = {}
+
+def get_csv_filename(account_name):
+    if incremental:
+        return f"{account_name}_transactions_{start_date.strftime('%Y%m%d')}_ledger_hafsql.csv"
+    return f"{account_name}_transactions_{start_date.strftime('%Y%m%d')}_to_{end_date.strftime('%Y%m%d')}_hafsql.csv"
+
+def fetch_transactions(account_names):
+    # Get transactions for the given accounts and time range, or since the last run when exporting incrementally
+    fetch_start, fetch_end, after_ids = start_date, end_date, None
+    if incremental:
+        fetch_end = covered_end_date(end_date)
+        states = {a: load_state(get_csv_filename(a)) for a in account_names}
+        pending = [a for a in account_names if states[a] is None or states[a]['end_date'] < fetch_end]
+        if not pending:
+            print(f"{', '.join(account_names)}: already exported up to {fetch_end}")
+            return {a: new_transactions() for a in account_names}
+        fetch_start = min(states[a]['end_date'] if states[a] else start_date for a in pending)
+        after_ids = {a: states[a]['last_id'] for a in account_names if states[a]}
+        # Last id of the fetched range, the next run skips the operations up to it
+        last_id = id_planner.bounds(fetch_start, fetch_end)[1]
+        for a in account_names:
+            high_water_marks[a] = states[a] if a not in pending else {'end_date': fetch_end, 'last_id': last_id}
 
-    print(f"\nTotal transactions collected: {len(transactions)}")
+    transactions = get_transactions_for_accounts(account_names, fetch_start, fetch_end, after_ids)
 
-    # Sort transactions by date
-    transactions.sort(key=lambda x: x[0])
+    for account_name, account_transactions in transactions.items():
+        # Transactions are sorted when aggregated
+        print(f"\n{account_name}: total transactions collected: {len(account_transactions)}")
+    return transactions
+
+def write_csv(account_name, aggregated_data):
+    csv_filename = get_csv_filename(account_name)
+    with timed('to_csv'):
+        if incremental:
+            # Merge into the existing ledger, then move the high-water mark
+            filename = csv_filename
+            merge_csv(csv_filename, aggregated_data)
+            save_state(csv_filename, high_water_marks.pop(account_name))
+        else:
+            # Export in the output format, the file appears once it is complete
+            filename = output_filename(csv_filename, output_format, output_dataset, account_name)
+            write_output(aggregated_data, filename, output_format)
+    count('to_csv', 'rows', len(aggregated_data))
+    count('to_csv', 'bytes', os.path.getsize(filename))
 
-    # Aggregate the transactions by date and type
-    aggregated_data = aggregate_transactions(transactions)
+    print(f"File saved as: {filename}")
 
-    # Export to CSV
-    csv_filename = f"{a}_transactions_{start_date.strftime('%Y%m%d')}_to_{end_date.strftime('%Y%m%d')}_hafsql.csv"
-    aggregated_data.to_csv(csv_filename, index=False)
+if __name__ == '__main__':
+    end_date = end_date + timedelta(days=1) - timedelta(seconds=1)
 
-    print(f"CSV file saved as: {csv_filename}")
+    # Aggregate the transactions of each account by date and type and export them to CSV
+    failed = run_exports(account_names, fetch_transactions, aggregate_transactions, write_csv, workers, aggregate_workers, account_batch_size)
+    database.close()
+    ratio_database.close()
+    print_metrics()
+    write_report(metrics_file, prometheus_file)
+    if failed:
+        sys.exit(1)
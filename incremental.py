@@ -0,0 +1,44 @@
+import json
+import os
+import pandas as pd
+from datetime import datetime, timedelta
+
+key_columns = ['date', 'type', 'direction', 'sender', 'recipient', 'currency']
+
+def covered_end_date(end_date, lag=timedelta(minutes=10)):
+    # Incremental runs stop a bit before the head block, so a later run never misses operations that
+    # were not irreversible or not synced yet
+    return min(end_date, datetime.utcnow() - lag)
+
+def state_filename(csv_filename):
+    # The high-water mark of an incremental export is kept next to its CSV
+    return csv_filename + '.state.json'
+
+def load_state(csv_filename):
+    # Returns the state of the last run with end_date as datetime, or None if there was none
+    if not os.path.exists(state_filename(csv_filename)) or not os.path.exists(csv_filename):
+        return None
+    with open(state_filename(csv_filename)) as f:
+        state = json.load(f)
+    state['end_date'] = datetime.fromisoformat(state['end_date'])
+    return state
+
+def save_state(csv_filename, state):
+    state = dict(state, end_date=state['end_date'].isoformat())
+    tmp_filename = state_filename(csv_filename) + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_filename, state_filename(csv_filename))
+
+def merge_csv(csv_filename, aggregated_data):
+    # Adds newly aggregated transactions to the existing CSV. Groups that only exist in one of them
+    # are kept as they are, groups of the day the last run stopped in are summed up.
+    if os.path.exists(csv_filename):
+        existing = pd.read_csv(csv_filename, dtype={c: str for c in key_columns})
+        aggregated_data = aggregated_data.astype({c: str for c in key_columns})
+        aggregated_data['amount'] = pd.to_numeric(aggregated_data['amount'])
+        aggregated_data = pd.concat([existing, aggregated_data], ignore_index=True)
+        aggregated_data = aggregated_data.groupby(key_columns).sum().reset_index()
+    tmp_filename = csv_filename + '.tmp'
+    aggregated_data.to_csv(tmp_filename, index=False)
+    os.replace(tmp_filename, csv_filename)
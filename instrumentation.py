@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+import functools
+import json
+import threading
+import time
+import transport
+
+# Time spent per stage and operation type, summed over all threads, and counters (rows, bytes, retries, ...)
+# per stage and operation type. Operation type '' holds what is not specific to one type.
+stages = {}
+counters = {}
+lock = threading.Lock()
+
+@contextmanager
+def timed(stage, op_type=''):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        with lock:
+            timing = stages.setdefault(stage, {}).setdefault(op_type, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            timing['calls'] += 1
+            timing['seconds'] += elapsed
+            timing['max_seconds'] = max(timing['max_seconds'], elapsed)
+
+def timer(stage):
+    # Decorator timing every call of a function as the stage
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(stage, name, n=1, op_type=''):
+    with lock:
+        stage_counters = counters.setdefault(stage, {}).setdefault(op_type, {})
+        stage_counters[name] = stage_counters.get(name, 0) + n
+
+def report():
+    with lock:
+        stage_report = {}
+        for stage in sorted(set(stages) | set(counters)):
+            stage_report[stage] = {}
+            for op_type in sorted(set(stages.get(stage, {})) | set(counters.get(stage, {}))):
+                entry = dict(stages.get(stage, {}).get(op_type, {}))
+                entry.update(counters.get(stage, {}).get(op_type, {}))
+                for k in ['seconds', 'max_seconds']:
+                    if k in entry:
+                        entry[k] = round(entry[k], 6)
+                stage_report[stage][op_type or 'all'] = entry
+    with transport.metrics_lock:
+        transport_report = dict(transport.metrics)
+    transport_report['http_connections_opened'] = transport.http_connections_opened()
+    return {'stages': stage_report, 'transport': transport_report}
+
+def prometheus_text(run_report, prefix='hive_export'):
+    # The report in the Prometheus text format, counters labelled by stage and operation type
+    lines = []
+    samples = {}
+    for stage, op_types in run_report['stages'].items():
+        for op_type, entry in op_types.items():
+            for name, value in entry.items():
+                metric = f"{prefix}_{name}" if name == 'max_seconds' else f"{prefix}_{name}_total"
+                samples.setdefault(metric, []).append(f'{metric}{{stage="{stage}",op_type="{op_type}"}} {value}')
+    for name, value in run_report['transport'].items():
+        samples.setdefault(f"{prefix}_{name}_total", []).append(f"{prefix}_{name}_total {value}")
+    for metric, metric_samples in samples.items():
+        lines.append(f"# TYPE {metric} {'gauge' if metric.endswith('max_seconds') else 'counter'}")
+        lines.extend(metric_samples)
+    return '\n'.join(lines) + '\n'
+
+def print_report(run_report):
+    # Totals over the operation types of each stage
+    for stage, op_types in run_report['stages'].items():
+        seconds = sum(e.get('seconds', 0) for e in op_types.values())
+        totals = {}
+        for e in op_types.values():
+            for k, v in e.items():
+                if k not in ['calls', 'seconds', 'max_seconds']:
+                    totals[k] = totals.get(k, 0) + v
+        timing = [f"{seconds:.3f}s"] if any('seconds' in e for e in op_types.values()) else []
+        print(f"Stage {stage}: " + ', '.join(timing + [f"{k}={v}" for k, v in totals.items()]))
+
+def write_report(json_file=None, prometheus_file=None):
+    # Prints the time per stage and writes the JSON report and the Prometheus text if their files are given
+    run_report = report()
+    print_report(run_report)
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(run_report, f, indent=2)
+        print(f"Metrics saved as: {json_file}")
+    if prometheus_file:
+        with open(prometheus_file, 'w') as f:
+            f.write(prometheus_text(run_report))
+        print(f"Prometheus metrics saved as: {prometheus_file}")
+    return run_report
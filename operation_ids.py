@@ -0,0 +1,60 @@
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+
+class OperationIdPlanner:
+    # Resolves timestamps to operation ids once and keeps them, so queries filter on plain id ranges and rows
+    # are dated by the day their id falls in. fetch_many(timestamps) returns the ids of the timestamps in the
+    # same order, like hafsql.id_from_timestamp. Ids only grow with time, so the operations of a day are the
+    # ones from the id of its midnight up to the id of the next midnight.
+    def __init__(self, fetch_many):
+        self.fetch_many = fetch_many
+        self.ids = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, timestamps):
+        # Ids of the timestamps, looking up the ones not resolved before with one call
+        with self.lock:
+            missing = sorted({t for t in timestamps if t not in self.ids})
+            if missing:
+                self.ids.update(zip(missing, self.fetch_many(missing)))
+            return [self.ids[t] for t in timestamps]
+
+    def edges(self, start, end):
+        # Timestamps whose ids bound a range: its start, and the second after its end
+        return [start, end + timedelta(seconds=1)]
+
+    def bounds(self, start, end):
+        # First and last id of a range, for id BETWEEN %(start_id)s AND %(end_id)s. The range ends before the id of
+        # the second after its end, so ranges split at a second, like the chunks, never share an operation.
+        start_id, next_id = self.resolve(self.edges(start, end))
+        return start_id, next_id - 1
+
+    def midnights(self, start, end):
+        # Midnights of the days from start to end
+        day = datetime.combine(start.date(), datetime.min.time())
+        days = []
+        while day <= end:
+            days.append(day)
+            day += timedelta(days=1)
+        return days
+
+    def day_edges(self, start, end):
+        # Midnights of the days from start to end, followed by the midnight the last day ends at
+        days = self.midnights(start, end)
+        return days + [days[-1] + timedelta(days=1)]
+
+    def days(self, start, end):
+        # Midnights of the days from start to end, and the ids the days start at followed by the id the last one ends at
+        edges = self.day_edges(start, end)
+        return edges[:-1], np.array(self.resolve(edges), dtype=np.int64)
+
+    def bucket(self, ids, start, end):
+        # Days of the operation ids of a range between start and end
+        days, day_ids = self.days(start, end)
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = np.searchsorted(day_ids, ids, side='right') - 1
+        outside = (positions < 0) | (positions >= len(days))
+        if outside.any():
+            raise ValueError(f"Operation id {ids[outside][0]} is not from {start} to {end}")
+        return [days[p] for p in positions.tolist()]
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import threading
+import pandas as pd
+from datetime import datetime, timedelta
+from aggregation import columns
+
+# Rows are kept with their timestamp and id (account history index for beem, operation id for HAFSQL)
+store_columns = ['timestamp', 'id'] + columns
+
+def merge_ranges(ranges):
+    # Merges overlapping and adjacent (start, end) ranges, both ends included
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + timedelta(seconds=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+class OperationStore:
+    # Local store of normalized operations per account and operation type. Rows are written to Parquet
+    # files named after the hash of their content, and a manifest per account lists the files of each
+    # operation type with the time range they cover, so any part of a covered range is read from disk
+    # and only the gaps have to be fetched. Needs pyarrow.
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    def _account_directory(self, account):
+        return os.path.join(self.directory, account)
+
+    def _load_manifest(self, account):
+        path = os.path.join(self._account_directory(account), 'manifest.json')
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def _save_manifest(self, account, manifest):
+        path = os.path.join(self._account_directory(account), 'manifest.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def op_types(self, account):
+        # Operation types stored for the account
+        return list(self._load_manifest(account))
+
+    def covered(self, account, op_type):
+        # Merged (start, end) ranges stored for the operation type, both ends included
+        entries = self._load_manifest(account).get(op_type, [])
+        return merge_ranges((datetime.fromisoformat(e['start']), datetime.fromisoformat(e['end'])) for e in entries)
+
+    def missing(self, account, op_types, start_date, end_date):
+        # Ranges between start_date and end_date that are not stored for all of the operation types
+        missing = []
+        for op_type in op_types:
+            current = start_date
+            for start, end in self.covered(account, op_type):
+                if end < current:
+                    continue
+                if start > end_date:
+                    break
+                if start > current:
+                    missing.append((current, start - timedelta(seconds=1)))
+                current = end + timedelta(seconds=1)
+            if current <= end_date:
+                missing.append((current, end_date))
+        # Merge the gaps of all operation types
+        return merge_ranges(missing)
+
+    def write(self, account, op_type, rows, start_date, end_date):
+        # Stores the rows of an operation type fetched for the whole range, which may be empty
+        rows = pd.DataFrame(rows, columns=store_columns)
+        entry = {'start': start_date.isoformat(), 'end': end_date.isoformat(), 'file': None}
+        os.makedirs(self._account_directory(account), exist_ok=True)
+        if len(rows) > 0:
+            data = rows.to_parquet(index=False)
+            filename = hashlib.sha256(data).hexdigest() + '.parquet'
+            path = os.path.join(self._account_directory(account), filename)
+            if not os.path.exists(path):
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(path + '.tmp', path)
+            entry['file'] = filename
+        with self.lock:
+            manifest = self._load_manifest(account)
+            manifest.setdefault(op_type, []).append(entry)
+            self._save_manifest(account, manifest)
+
+    def read(self, account, op_types, start_date, end_date):
+        # Rows of the operation types between start_date and end_date, in the order they happened
+        manifest = self._load_manifest(account)
+        frames = []
+        for op_type in op_types:
+            for entry in manifest.get(op_type, []):
+                if entry['file'] is None:
+                    continue
+                if datetime.fromisoformat(entry['start']) > end_date or datetime.fromisoformat(entry['end']) < start_date:
+                    continue
+                frames.append(pd.read_parquet(os.path.join(self._account_directory(account), entry['file'])))
+        if not frames:
+            return pd.DataFrame(columns=store_columns)
+        rows = pd.concat(frames, ignore_index=True)
+        rows = rows[(rows['timestamp'] >= start_date) & (rows['timestamp'] <= end_date)]
+        # Ranges stored more than once are only counted once
+        rows = rows.drop_duplicates()
+        return rows.sort_values(['timestamp', 'id'], kind='stable').reset_index(drop=True)
@@ -0,0 +1,99 @@
+import gzip
+import io
+import os
+
+# File extension of each output format
+extensions = {
+    'csv': '.csv',
+    'csv.gz': '.csv.gz',
+    'csv.zst': '.csv.zst',
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+}
+
+class OutputWriter:
+    # Writes one or more DataFrames to a temporary file next to the target, which replaces the target
+    # on close, so an interrupted export never leaves a truncated file behind. CSV can be compressed with
+    # gzip or zstd (needs zstandard), Parquet and Arrow IPC need pyarrow.
+
+    def __init__(self, filename, output_format='csv'):
+        if output_format not in extensions:
+            raise ValueError(f"Unknown output format {output_format}, use one of {', '.join(extensions)}")
+        self.filename = filename
+        self.output_format = output_format
+        self.tmp_filename = filename + '.tmp'
+        self.file = None
+        self.writer = None
+        self.schema = None
+        self.chunks = 0
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _open(self):
+        if self.output_format == 'csv':
+            return open(self.tmp_filename, 'w', newline='')
+        if self.output_format == 'csv.gz':
+            return gzip.open(self.tmp_filename, 'wt', newline='')
+        if self.output_format == 'csv.zst':
+            import zstandard
+            return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(self.tmp_filename, 'wb')), newline='')
+        return open(self.tmp_filename, 'wb')
+
+    def write(self, df):
+        if self.file is None:
+            self.file = self._open()
+        if self.output_format.startswith('csv'):
+            df.to_csv(self.file, index=False, header=self.chunks == 0)
+            self.chunks += 1
+            return
+
+        import pyarrow as pa
+        # Sums of Decimals become floats, so every chunk has the same schema
+        table = pa.Table.from_pandas(df.astype({'amount': 'float64'}), preserve_index=False)
+        if self.writer is None:
+            self.schema = table.schema
+            if self.output_format == 'parquet':
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(self.file, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.file, self.schema)
+        self.writer.write_table(table.cast(self.schema))
+        self.chunks += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.file is not None:
+            self.file.close()
+        os.replace(self.tmp_filename, self.filename)
+
+    def abort(self):
+        # The Parquet or Arrow writer is closed too, it holds the file open. Errors closing it are left out so
+        # the one that made the write fail is raised.
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception:
+                pass
+        if self.file is not None:
+            self.file.close()
+        if os.path.exists(self.tmp_filename):
+            os.remove(self.tmp_filename)
+
+def output_filename(csv_filename, output_format='csv', dataset=None, account_name=None):
+    # The CSV filename with the extension of the format, inside the account's partition of the dataset if given
+    filename = csv_filename.removesuffix('.csv') + extensions[output_format]
+    if dataset:
+        filename = os.path.join(dataset, f"account={account_name}", os.path.basename(filename))
+    return filename
+
+def write_output(aggregated_data, filename, output_format='csv'):
+    # Writes the aggregates to the file, which only appears once it is complete
+    writer = OutputWriter(filename, output_format)
+    try:
+        writer.write(aggregated_data)
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
@@ -0,0 +1,101 @@
+import os
+import sys
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer
+import pandas as pd
+import psycopg2
+
+# The engine against the benchmark's fake database and account history: when HAFSQL fails part way through an
+# export, the remaining ranges of every operation type must come from the account history instead.
+#
+#   python -m pytest tests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import engine
+import hive_tx_to_csv as rpc_backend
+import hive_tx_to_csv_hafsql as hafsql_backend
+import transport
+
+ops = 2000
+accounts = ['account0']
+
+class FailingDatabase(benchmark.FakeDatabase):
+    # Raises OperationalError for every query after the first healthy_queries, like a database that went down
+    def __init__(self, ops_per_type, healthy_queries):
+        super().__init__(ops_per_type, 0)
+        self.healthy_queries = healthy_queries
+
+    def answer(self, query, params):
+        if 'id_from_timestamp' not in query:
+            if self.healthy_queries <= 0:
+                raise psycopg2.OperationalError('server closed the connection unexpectedly')
+            self.healthy_queries -= 1
+        return super().answer(query, params)
+
+def setup_sources(healthy_queries):
+    benchmark.RPCHandler.ops = ops
+    server = ThreadingHTTPServer(('127.0.0.1', 0), benchmark.RPCHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    rpc_backend.hafsql = url
+    rpc_backend.node_pool = transport.NodePool([url])
+    rpc_backend.ratio_cache = rpc_backend.VestsToHiveRatioCache(rpc_backend.get_vests_to_hive_ratios, rpc_backend.get_vests_to_hive_ratio, None)
+    rpc_backend.get_account = benchmark.fake_account_class(ops, 0)
+    rpc_backend.get_hive = lambda: None
+    rpc_backend.operation_store = None
+
+    hafsql_backend.database = FailingDatabase(ops, healthy_queries)
+    hafsql_backend.ratio_database = benchmark.FakeDatabase(ops, 0)
+    hafsql_backend.ratio_cache_file = None
+    hafsql_backend.operation_store = None
+    # Failing queries give up at once instead of being split
+    hafsql_backend.min_chunk_interval = timedelta(days=400)
+    hafsql_backend.chunk_intervals.clear()
+
+    engine.planner = None
+    engine.configure(account_names=accounts, start_date=datetime(2024, 1, 1), end_date=datetime(2024, 12, 31),
+                     sources=['hafsql', 'rpc'], plan_interval=timedelta(days=31), source_cooldown=60, workers=1)
+    return server
+
+def export(healthy_queries):
+    # Runs engine.main in a temporary directory, returns its exit code and the exported CSV
+    server = setup_sources(healthy_queries)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            code = engine.main()
+            filename = engine.get_csv_filename(accounts[0])
+            return code, pd.read_csv(filename) if os.path.exists(filename) else None
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+
+def test_falls_back_to_rpc_when_hafsql_goes_down():
+    code, df = export(healthy_queries=20)
+    assert code == 0
+    assert df is not None
+    health = engine.get_planner().health
+    assert health['hafsql']['failures'] > 0
+    # Every operation type of the account history, fill_order included, is exported after HAFSQL went down
+    late = df[pd.to_datetime(df['date']) >= datetime(2024, 7, 1)]
+    assert set(benchmark.history_op_types) - {'vote'} <= set(late['type'])
+    late_fills = late[late['type'] == 'fill_order']
+    assert ((late_fills['sender'] == 'hive.market') | (late_fills['recipient'] == 'hive.market')).all()
+
+def test_uses_hafsql_while_healthy():
+    code, df = export(healthy_queries=10**6)
+    assert code == 0
+    health = engine.get_planner().health
+    assert health['hafsql']['failures'] == 0
+    assert len(df) and df['date'].nunique() > 300
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(f"{name} passed")
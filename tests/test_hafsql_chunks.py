@@ -0,0 +1,91 @@
+import os
+import sys
+from collections import Counter
+from datetime import timedelta
+import psycopg2
+
+# Chunked HAFSQL queries against the benchmark's fake database must return the same rows as one query over the
+# whole range, without duplicating the operations at the chunk bounds.
+#
+#   python -m pytest tests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import hive_tx_to_csv_hafsql as exporter
+from operation_ids import OperationIdPlanner
+
+accounts = ['account0', 'account1']
+tx_type = 'transfer'
+
+def setup_exporter(ops=2000, day_buckets=False):
+    exporter.database = exporter.ratio_database = benchmark.FakeDatabase(ops, 0)
+    exporter.id_planner = OperationIdPlanner(exporter.get_operation_ids)
+    exporter.operation_store = None
+    exporter.streaming = exporter.server_aggregation = exporter.client_vests_conversion = False
+    exporter.day_buckets = day_buckets
+    exporter.chunk_intervals.clear()
+
+def fetch(interval=None):
+    # Rows with their ids, over the whole range or in chunks of interval
+    if interval is not None:
+        exporter.chunk_intervals[tx_type] = interval
+    query = exporter.queries_by_type()[tx_type]
+    result = exporter.fetch_query(query, tx_type, accounts, benchmark.start_date, benchmark.end_date, with_ids=True)
+    exporter.chunk_intervals.clear()
+    return result
+
+def check_chunks_match_whole_range(day_buckets):
+    setup_exporter(day_buckets=day_buckets)
+    whole = fetch()
+    chunked = fetch(timedelta(days=7))
+    for account in accounts:
+        ids = [row[-1] for row in chunked[account]]
+        assert not [i for i, n in Counter(ids).items() if n > 1]
+        assert sorted(chunked[account], key=lambda row: row[-1]) == sorted(whole[account], key=lambda row: row[-1])
+
+def test_chunks_match_whole_range():
+    check_chunks_match_whole_range(day_buckets=False)
+
+def test_chunks_match_whole_range_with_day_buckets():
+    check_chunks_match_whole_range(day_buckets=True)
+
+class OverloadedDatabase(benchmark.FakeDatabase):
+    # Fails the queries over more than max_ids operations, like a statement timeout
+    def __init__(self, ops_per_type, latency, max_ids=300):
+        super().__init__(ops_per_type, latency)
+        self.max_ids = max_ids
+        self.failures = 0
+
+    def answer(self, query, params):
+        if 'id_from_timestamp' not in query and params['end_id'] - params['start_id'] > self.max_ids:
+            self.failures += 1
+            raise psycopg2.Error()
+        return super().answer(query, params)
+
+def test_bisected_chunks_match_whole_range():
+    # Failed chunks are split, the second half starting the second after the middle
+    setup_exporter()
+    whole = fetch()
+    exporter.database = OverloadedDatabase(2000, 0)
+    chunked = fetch(timedelta(days=120))
+    for account in accounts:
+        assert sorted(chunked[account], key=lambda row: row[-1]) == sorted(whole[account], key=lambda row: row[-1])
+
+def test_rejecting_database_gives_up_early():
+    # Bisection goes depth first and stops at the first failed chunk of min_chunk_interval or max_chunk_retries
+    setup_exporter()
+    exporter.database = OverloadedDatabase(2000, 0, max_ids=-1)
+    try:
+        fetch(timedelta(days=30))
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('fetch_query did not give up')
+    assert exporter.database.failures <= 13 + 2 * exporter.max_chunk_retries
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(f"{name} passed")
@@ -0,0 +1,187 @@
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+# HTTP requests are retried up to http_retries times, waiting http_backoff * 2^n seconds in between
+http_retries = 5
+http_backoff = 0.5
+http_timeout = 30
+http_pool_size = 16
+# Nodes failing a call are skipped for node_cooldown * 2^(failures-1) seconds, at most max_node_cooldown
+node_cooldown = 5
+max_node_cooldown = 300
+
+metrics = {
+    'http_requests': 0,
+    'http_retries': 0,
+    'http_bytes_received': 0,
+    'node_failovers': 0,
+    'db_connections_opened': 0,
+    'db_connections_reused': 0,
+}
+metrics_lock = threading.Lock()
+
+def count(metric, n=1):
+    with metrics_lock:
+        metrics[metric] += n
+
+# Shared keep-alive session
+session = None
+session_lock = threading.Lock()
+
+def get_session():
+    # urllib3 does not retry, failed requests are only retried by post_json so the attempts and the backoff
+    # don't multiply. requests is only imported once a request is made, which keeps startup fast.
+    global session
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    with session_lock:
+        if session is None:
+            adapter = HTTPAdapter(pool_connections=http_pool_size, pool_maxsize=http_pool_size, max_retries=Retry(total=0, raise_on_status=False))
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        return session
+
+def post_json(url, data, headers=None, retry_rpc_errors=True, retries=None):
+    # Posts and decodes the JSON response, retrying on network errors, invalid responses and JSON-RPC errors
+    import requests
+    retries = http_retries if retries is None else retries
+    for attempt in range(retries + 1):
+        try:
+            count('http_requests')
+            response = get_session().post(url, data=data, headers=headers, timeout=http_timeout)
+            response.raise_for_status()
+            count('http_bytes_received', len(response.content))
+            result = response.json()
+            if retry_rpc_errors and isinstance(result, dict) and 'error' in result:
+                raise ValueError(f"JSON-RPC error: {result['error']}")
+            return result
+        except (requests.RequestException, ValueError):
+            if attempt == retries:
+                raise
+            count('http_retries')
+            time.sleep(http_backoff * 2 ** attempt)
+
+class NodePool:
+    # Spreads JSON-RPC calls over several nodes, preferring the healthy ones with the fewest calls in flight
+    # and the lowest latency. A call failing on one node is retried right away on the next, and the failed
+    # node is left out until its cooldown has passed.
+
+    def __init__(self, nodes):
+        self.lock = threading.Lock()
+        self.health = {node: {'in_flight': 0, 'failures': 0, 'down_until': 0, 'latency': 0} for node in nodes}
+
+    def _choose(self, tried):
+        with self.lock:
+            now = time.monotonic()
+            candidates = [n for n in self.health if n not in tried] or list(self.health)
+            up = [n for n in candidates if self.health[n]['down_until'] <= now]
+            if up:
+                node = min(up, key=lambda n: (self.health[n]['in_flight'], self.health[n]['latency']))
+            else:
+                node = min(candidates, key=lambda n: self.health[n]['down_until'])
+            self.health[node]['in_flight'] += 1
+            return node
+
+    def _report(self, node, elapsed=None):
+        # elapsed is None for failed calls
+        with self.lock:
+            health = self.health[node]
+            health['in_flight'] -= 1
+            if elapsed is None:
+                health['failures'] += 1
+                health['down_until'] = time.monotonic() + min(node_cooldown * 2 ** (health['failures'] - 1), max_node_cooldown)
+            else:
+                health['failures'] = 0
+                health['latency'] = elapsed if not health['latency'] else 0.8 * health['latency'] + 0.2 * elapsed
+
+    def call(self, method, params):
+        import requests
+        data = json.dumps({'jsonrpc': '2.0', 'method': method, 'params': params, 'id': 1})
+        tried = []
+        for attempt in range(http_retries + 1):
+            node = self._choose(tried)
+            started = time.monotonic()
+            try:
+                response = post_json(node, data, retries=0)
+                if not isinstance(response, dict) or 'result' not in response:
+                    raise ValueError(f"Invalid response from {node}")
+            except (requests.RequestException, ValueError):
+                self._report(node)
+                if attempt == http_retries:
+                    raise
+                count('node_failovers')
+                tried.append(node)
+                # Back off once every node has failed
+                if len(tried) >= len(self.health):
+                    tried = []
+                    time.sleep(http_backoff * 2 ** attempt)
+                continue
+            self._report(node, time.monotonic() - started)
+            return response['result']
+
+class DatabasePool:
+    # Thread safe pool of psycopg2 connections. Connections are opened on demand, at most
+    # max_connections at a time, and kept open for reuse. Callers wait for a free connection.
+
+    def __init__(self, params, max_connections=8):
+        self.params = params
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    @contextmanager
+    def connection(self):
+        # Only needed by the HAFSQL exporter
+        import psycopg2
+
+        with self.slots:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None or conn.closed:
+                conn = psycopg2.connect(**self.params)
+                count('db_connections_opened')
+            else:
+                count('db_connections_reused')
+            try:
+                yield conn
+            finally:
+                self.release(conn)
+
+    def release(self, conn):
+        # Ends the transaction, or the aborted one after a failed query, and drops broken connections
+        if conn.closed:
+            return
+        try:
+            conn.rollback()
+        except Exception:
+            conn.close()
+            return
+        with self.lock:
+            self.idle.append(conn)
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+def http_connections_opened():
+    # New connections made by the pools of the shared session
+    opened = 0
+    if session is not None:
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                opened += pools[key].num_connections
+    return opened
+
+def print_metrics():
+    with metrics_lock:
+        summary = dict(metrics)
+    summary['http_connections_opened'] = http_connections_opened()
+    print('Transport: ' + ', '.join(f"{k}={v}" for k, v in summary.items()))
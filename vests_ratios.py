@@ -0,0 +1,95 @@
+import sqlite3
+import threading
+
+class VestsToHiveRatioCache:
+    # VESTS to HIVE ratios by block, kept in memory and optionally in an SQLite file shared by runs.
+    # fetch_many(block_nums) returns the ratios it could get as a dict, fetch_one(block_num) the ratio of
+    # a single block or raises. With a sample_stride only every n-th block is looked up and the ratios in
+    # between are interpolated, unless the samples differ by more than the tolerance.
+    def __init__(self, fetch_many, fetch_one, filename=None, batch_size=100, sample_stride=None, tolerance=0.0001):
+        self.fetch_many = fetch_many
+        self.fetch_one = fetch_one
+        self.batch_size = batch_size
+        self.sample_stride = sample_stride
+        self.tolerance = tolerance
+        self.ratios = {}
+        self.unavailable = set()
+        self.db = None
+        # Guards the database, which is shared by the export threads
+        self.lock = threading.Lock()
+        if filename:
+            self.db = sqlite3.connect(filename, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS vests_to_hive_ratio (block_num INTEGER PRIMARY KEY, ratio REAL NOT NULL)')
+            self.db.commit()
+
+    def _load(self, block_nums):
+        # Read ratios already stored on disk
+        block_nums = list(block_nums)
+        for i in range(0, len(block_nums), 500):
+            chunk = block_nums[i:i+500]
+            with self.lock:
+                rows = self.db.execute('SELECT block_num, ratio FROM vests_to_hive_ratio WHERE block_num IN ('+','.join('?'*len(chunk))+')', chunk).fetchall()
+            self.ratios.update(rows)
+
+    def _store(self, ratios):
+        self.ratios.update(ratios)
+        if self.db is not None and ratios:
+            with self.lock:
+                self.db.executemany('INSERT OR REPLACE INTO vests_to_hive_ratio (block_num, ratio) VALUES (?, ?)', ratios.items())
+                self.db.commit()
+
+    def _fetch(self, block_nums):
+        # Load the given blocks from disk or the network, returns the blocks that could not be fetched
+        missing = [b for b in set(block_nums) if b not in self.ratios]
+        if self.db is not None and missing:
+            self._load(missing)
+            missing = [b for b in missing if b not in self.ratios]
+        missing.sort()
+        for i in range(0, len(missing), self.batch_size):
+            self._store(self.fetch_many(missing[i:i+self.batch_size]))
+        return [b for b in missing if b not in self.ratios]
+
+    def _samples(self, block_num):
+        lower = block_num - block_num % self.sample_stride
+        return lower, lower + self.sample_stride
+
+    def _interpolate(self, block_num):
+        # Interpolated ratio between the surrounding samples, None if they are unavailable or too far apart
+        lower, upper = self._samples(block_num)
+        if block_num == lower:
+            return self.ratios.get(lower)
+        if lower not in self.ratios or upper not in self.ratios:
+            return None
+        lower_ratio = self.ratios[lower]
+        upper_ratio = self.ratios[upper]
+        if abs(upper_ratio - lower_ratio) > self.tolerance * lower_ratio:
+            return None
+        return lower_ratio + (upper_ratio - lower_ratio) * (block_num - lower) / self.sample_stride
+
+    def prefetch(self, block_nums):
+        block_nums = set(block_nums)
+        if self.sample_stride:
+            samples = set()
+            for b in block_nums:
+                samples.update(self._samples(b))
+            # Samples beyond the last available block are only looked up once
+            self.unavailable.update(self._fetch(samples - self.unavailable))
+            block_nums = [b for b in block_nums if self._interpolate(b) is None]
+        for b in self._fetch(block_nums):
+            self._store({b: self.fetch_one(b)})
+
+    def _cached(self, block_num):
+        # Ratio from the samples or the blocks loaded so far, None if they don't have it
+        if self.sample_stride:
+            ratio = self._interpolate(block_num)
+            if ratio is not None:
+                return ratio
+        return self.ratios.get(block_num)
+
+    def get(self, block_num):
+        ratio = self._cached(block_num)
+        if ratio is None:
+            # prefetch either loads the samples to interpolate the block from, or the block itself
+            self.prefetch([block_num])
+            ratio = self._cached(block_num)
+        return ratio